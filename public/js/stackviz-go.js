@@ -16,6 +16,31 @@ $(document).ready(function() {
   var statusGerrit = $('#status-gerrit');
   var statusUuid = $('#status-uuid');
 
+  // returns true if the status is final and no further updates are expected
+  var updateStatus = function(uuid, data) {
+    var text = data.status;
+    if (text === 'error' && data.message) {
+      text += ': ' + data.message;
+
+      statusMessage.addClass('text-danger');
+    } else if (data.total && typeof data.completed === 'number') {
+      text += ' (' + data.completed + '/' + data.total + ' artifacts)';
+    }
+    statusMessage.text(text);
+
+    if (data.status.toLowerCase() === 'finished') {
+      statusMessage.text('redirecting...');
+
+      setTimeout(function() {
+        window.location.assign('/s/' + uuid + '/');
+      }, 1000);
+
+      return true;
+    }
+
+    return data.status.toLowerCase() === 'error';
+  };
+
   var checkStatus = function(uuid) {
     $.ajax({
       url: '/api/status',
@@ -24,21 +49,7 @@ $(document).ready(function() {
       dataType: 'json',
       data: JSON.stringify({ q: uuid }),
       success: function(data) {
-        var text = data.status;
-        if (text === 'error' && data.message) {
-          text += ': ' + data.message;
-
-          statusMessage.addClass('text-danger');
-        }
-        statusMessage.text(text);
-
-        if (data.status.toLowerCase() === 'finished') {
-          statusMessage.text('redirecting...');
-
-          setTimeout(function() {
-            window.location.assign('/s/' + uuid + '/');
-          }, 1000);
-        } else if (data.status.toLowerCase() !== 'error') {
+        if (!updateStatus(uuid, data)) {
           setTimeout(function() {
             checkStatus(uuid);
           }, 1000);
@@ -47,6 +58,30 @@ $(document).ready(function() {
     });
   };
 
+  var watchStatus = function(uuid) {
+    if (!window.EventSource) {
+      checkStatus(uuid);
+      return;
+    }
+
+    var received = false;
+    var source = new EventSource('/api/events/' + uuid);
+    source.onmessage = function(e) {
+      received = true;
+      if (updateStatus(uuid, JSON.parse(e.data))) {
+        source.close();
+      }
+    };
+    source.onerror = function() {
+      // the browser reconnects on its own once a stream has worked;
+      // otherwise events are unavailable, so poll instead
+      if (!received) {
+        source.close();
+        checkStatus(uuid);
+      }
+    };
+  };
+
   var requestScrape = function(artifact, job) {
     status.show();
     statusMessage.text('initializing...');
@@ -73,7 +108,21 @@ $(document).ready(function() {
       }),
       success: function(data) {
         statusUuid.text(data.uuid);
-        checkStatus(data.uuid);
+        watchStatus(data.uuid);
+      },
+      error: function(xhr) {
+        if (xhr.status === 429) {
+          // the server is busy; wait as long as it asks, then try again
+          var delay = parseInt(xhr.getResponseHeader('Retry-After'), 10);
+          if (isNaN(delay)) {
+            delay = 30;
+          }
+
+          statusMessage.text('server busy, retrying in ' + delay + 's...');
+          setTimeout(function() {
+            requestScrape(artifact, job);
+          }, delay * 1000);
+        }
       }
     });
   };
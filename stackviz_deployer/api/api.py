@@ -12,57 +12,334 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
+import logging
+import os
+import time
 import uuid
 
+from io import BytesIO
+
+import redis
+import simplejson
+
 from flask import Flask
+from flask import g
 from flask import jsonify
 from flask import request
+from flask import Response
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from werkzeug.http import http_date
 
+from stackviz_deployer import metrics
+from stackviz_deployer.db import blob_store
 from stackviz_deployer.db import database
 from stackviz_deployer.db.models import ArtifactBlob
+from stackviz_deployer.db.models import make_url_key
 from stackviz_deployer.db.models import ScrapeTask
 from stackviz_deployer.scraper import url_matcher
+from stackviz_deployer.tasks import progress
+from stackviz_deployer.tasks import queues
 from stackviz_deployer.tasks import tasks
 
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 8192
+app.config['MAX_CONTENT_LENGTH'] = 65536
+
+# the maximum number of scrapes or task ids accepted by batch requests
+MAX_BATCH_SIZE = 100
+
+# the maximum duration of a single /events stream, in seconds; each stream
+# occupies a (sync) worker, so streams are kept to a short long-poll and
+# browsers reconnect automatically if a task is still running when it ends
+EVENTS_TIMEOUT = int(os.environ.get('EVENTS_TIMEOUT', '20'))
+
+# the interval between keepalive comments on idle /events streams, in seconds
+EVENTS_KEEPALIVE = 10
+
+# the delay before browsers reconnect to an ended /events stream, in ms
+EVENTS_RETRY = 1000
+
+# new scrapes are rejected while more than this many are waiting in their
+# lane's queue
+ADMISSION_MAX_QUEUED = int(os.environ.get('ADMISSION_MAX_QUEUED', '200'))
+
+# new scrapes are rejected while this many tasks are being processed; bulk
+# submissions are held to a lower limit so interactive requests get through
+ADMISSION_MAX_PENDING = int(os.environ.get('ADMISSION_MAX_PENDING', '200'))
+ADMISSION_BULK_MAX_PENDING = int(
+    os.environ.get('ADMISSION_BULK_MAX_PENDING', '50'))
+
+# the number of seconds rejected clients are asked to wait before retrying
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '30'))
+
+# in-flight tasks older than this many seconds are assumed lost (e.g. the
+# worker died) and no longer block new scrapes of the same URL
+SCRAPE_STALE_TIMEOUT = int(os.environ.get('SCRAPE_STALE_TIMEOUT', '3600'))
+
+# if set, blob content is served by nginx from this internal location via
+# X-Accel-Redirect rather than being read by the API server
+BLOB_ACCEL_PREFIX = os.environ.get('BLOB_ACCEL_PREFIX')
+
+# blobs never change once written, so they may be cached indefinitely
+BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 
 database.init_db()
+metrics.add_collector(queues.QueueLengthCollector())
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+
+@app.after_request
+def observe_request_time(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        metrics.REQUEST_SECONDS \
+            .labels(request.endpoint or 'unknown', request.method) \
+            .observe(time.time() - start)
+
+    return response
 
 
 def get_by_url(url):
+    """Find the usable (finished or in-flight) task for a URL, if any.
+
+    :param url: the artifact listing URL
+    :rtype: ScrapeTask
+    """
     return database.session.query(ScrapeTask).filter_by(
-        url=url,
-        status='success').first()
+        url_key=make_url_key(url)).first()
+
+
+def _expire_stale(db_task):
+    if db_task.status == 'finished':
+        return False
+
+    age = datetime.datetime.utcnow() - db_task.date
+    if age.total_seconds() < SCRAPE_STALE_TIMEOUT:
+        return False
+
+    db_task.status = 'error'
+    db_task.message = 'scrape task timed out'
+    db_task.url_key = None
+    database.session.add(db_task)
+    database.session.commit()
+
+    return True
+
+
+class AdmissionRejectedError(Exception):
+    """An error raised when workers are too busy to accept new scrapes."""
+    pass
+
+
+def _check_admission(lane, count=1):
+    """Reject new scrapes in a lane if its queue or the workers are full.
+
+    If the broker can't be reached, scrapes are admitted anyway. Pending
+    tasks older than `SCRAPE_STALE_TIMEOUT` are assumed lost and not
+    counted, so they can't block new scrapes indefinitely.
+
+    :param lane: `queues.INTERACTIVE_QUEUE` or `queues.BULK_QUEUE`
+    :param count: the number of new scrapes to be queued
+    :raises AdmissionRejectedError: if the scrape should be retried later
+    """
+    try:
+        queued = queues.queue_length(lane)
+    except redis.RedisError as e:
+        logger.warning('Could not check length of queue %s: %s', lane, e)
+        queued = 0
+
+    if lane == queues.BULK_QUEUE:
+        max_pending = ADMISSION_BULK_MAX_PENDING
+    else:
+        max_pending = ADMISSION_MAX_PENDING
+
+    stale_date = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=SCRAPE_STALE_TIMEOUT)
+    pending = database.session.query(ScrapeTask) \
+        .filter(ScrapeTask.status == 'pending') \
+        .filter(ScrapeTask.date > stale_date) \
+        .count()
+
+    # a batch is admitted whole, so all of it must fit in the queue
+    if queued + count > ADMISSION_MAX_QUEUED or pending >= max_pending:
+        metrics.ADMISSION_REJECTED.labels(lane).inc()
+        raise AdmissionRejectedError()
+
+
+def _rejected_response():
+    response = jsonify({
+        'error': 'too many scrapes in progress, try again later'
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+
+    return response
+
+
+def _create_task(listing_info):
+    url = listing_info['url']
+
+    return ScrapeTask(id=uuid.uuid4(),
+                      status='new',
+                      url=url,
+                      url_key=make_url_key(url),
+                      change_id=listing_info.get('change_id'),
+                      change_rev=listing_info.get('revision'),
+                      change_job=listing_info.get('name'),
+                      change_project=listing_info.get('change_project'),
+                      change_subject=listing_info.get('change_subject'),
+                      change_status=listing_info.get('status'),
+                      change_ci_username=listing_info.get('ci_username'),
+                      change_ci_pipeline=listing_info.get('pipeline'))
+
+
+def _submit_scrape(listing_info, lane=queues.INTERACTIVE_QUEUE):
+    """Queue a scrape of a listing, reusing an existing task if possible.
+
+    :param listing_info: the listing details, including 'url'
+    :param lane: the queue new tasks are submitted to
+    :raises AdmissionRejectedError: if a new task is needed but workers are
+                                    too busy
+    :return: a tuple of (ScrapeTask, True if a new task was queued)
+    """
+    url = listing_info['url']
+
+    # reuse finished results, or attach to an in-flight task for this URL
+    existing = get_by_url(url)
+    if existing and not _expire_stale(existing):
+        return existing, False
+
+    _check_admission(lane)
+    db_task = _create_task(listing_info)
+
+    database.session.add(db_task)
+    try:
+        database.session.commit()
+    except IntegrityError:
+        # lost a race with a concurrent submission of the same URL
+        database.session.rollback()
+
+        existing = get_by_url(url)
+        if existing:
+            return existing, False
+
+        raise
+
+    tasks.submit_scrape(db_task.id, lane)
+
+    return db_task, True
+
+
+def _scrape_result(db_task, created):
+    return {
+        'status': 'queued' if created else db_task.status,
+        'uuid': db_task.id
+    }
+
+
+def _batch_param(json, key):
+    """Get a list parameter from a batch request, checking its size.
+
+    :return: the list, or None if missing or invalid
+    """
+    values = json.get(key) if isinstance(json, dict) else None
+    if not isinstance(values, list) or len(values) > MAX_BATCH_SIZE:
+        return None
+
+    return values
+
+
+def _valid_listing_info(item):
+    return isinstance(item, dict) and isinstance(item.get('url'), basestring)
 
 
 @app.route('/scrape', methods=['POST'])
 def request_scrape():
-    # TODO(Tim Buckley) check for existing scrapes & validate input
+    # TODO(Tim Buckley) validate input
     listing_info = request.get_json()
 
-    task_id = uuid.uuid4()
-    db_task = ScrapeTask(id=task_id,
-                         status='new',
-                         url=listing_info['url'],
-                         change_id=listing_info.get('change_id'),
-                         change_rev=listing_info.get('revision'),
-                         change_job=listing_info.get('name'),
-                         change_project=listing_info.get('change_project'),
-                         change_subject=listing_info.get('change_subject'),
-                         change_status=listing_info.get('status'),
-                         change_ci_username=listing_info.get('ci_username'),
-                         change_ci_pipeline=listing_info.get('pipeline'))
+    try:
+        db_task, created = _submit_scrape(listing_info)
+    except AdmissionRejectedError:
+        return _rejected_response()
 
-    database.session.add(db_task)
-    database.session.commit()
+    return jsonify(_scrape_result(db_task, created)), \
+        200 if db_task.status == 'finished' else 202
 
-    tasks.request_scrape.delay(str(task_id))
 
-    return jsonify({
-        'status': 'queued',
-        'uuid': task_id
-    }), 202
+@app.route('/scrape/batch', methods=['POST'])
+def request_scrape_batch():
+    items = _batch_param(request.get_json(), 'items')
+    if items is None or not all(_valid_listing_info(i) for i in items):
+        return jsonify({
+            'error': 'expected a list of at most %d items, each with a url'
+                     % MAX_BATCH_SIZE
+        }), 400
+
+    keys = [make_url_key(item['url']) for item in items]
+
+    # find reusable tasks for all items in a single query
+    existing = {}
+    if keys:
+        q = database.session.query(ScrapeTask).filter(
+            ScrapeTask.url_key.in_(set(keys)))
+        for db_task in q:
+            if not _expire_stale(db_task):
+                existing[db_task.url_key] = db_task
+
+    # list of (task, created), with duplicate URLs sharing one new task
+    results = []
+    created = {}
+    for item, key in zip(items, keys):
+        if key in existing:
+            results.append((existing[key], False))
+        elif key in created:
+            results.append((created[key], True))
+        else:
+            created[key] = _create_task(item)
+            results.append((created[key], True))
+
+    if created:
+        try:
+            _check_admission(queues.BULK_QUEUE, len(created))
+        except AdmissionRejectedError:
+            return _rejected_response()
+
+        database.session.add_all(created.values())
+        try:
+            database.session.commit()
+        except IntegrityError:
+            # raced with another submission; fall back to one at a time
+            database.session.rollback()
+
+            try:
+                results = [_submit_scrape(item, queues.BULK_QUEUE)
+                           for item in items]
+            except AdmissionRejectedError:
+                return _rejected_response()
+
+            return jsonify(results=[_scrape_result(t, c)
+                                    for t, c in results]), 202
+
+        for db_task in created.values():
+            tasks.submit_scrape(db_task.id, queues.BULK_QUEUE)
+
+    return jsonify(results=[_scrape_result(t, c) for t, c in results]), 202
+
+
+def _status_result(db_task):
+    return {
+        'uuid': str(db_task.id),
+        'status': db_task.status,
+        'message': db_task.message
+    }
 
 
 @app.route('/status', methods=['POST'])
@@ -73,21 +350,96 @@ def request_status():
     db_task = database.session.query(ScrapeTask).filter_by(id=task_id).first()
 
     if db_task:
-        return jsonify({
-            'uuid': str(db_task.id),
-            'status': db_task.status,
-            'message': db_task.message
-        })
+        return jsonify(_status_result(db_task))
     else:
         return jsonify({'error': 'not found'}), 404
 
 
+@app.route('/status/batch', methods=['POST'])
+def request_status_batch():
+    values = _batch_param(request.get_json(), 'q')
+    if values is None:
+        return jsonify({
+            'error': 'expected a list of at most %d ids' % MAX_BATCH_SIZE
+        }), 400
+
+    task_ids = [uuid.UUID(value) for value in values]
+
+    # look up all tasks with a single IN (...) query
+    found = {}
+    if task_ids:
+        q = database.session.query(ScrapeTask).filter(
+            ScrapeTask.id.in_(task_ids))
+        found = dict((db_task.id, db_task) for db_task in q)
+
+    results = []
+    for task_id in task_ids:
+        if task_id in found:
+            results.append(_status_result(found[task_id]))
+        else:
+            results.append({'uuid': str(task_id), 'error': 'not found'})
+
+    return jsonify(results=results)
+
+
+def _sse_event(data):
+    return 'data: %s\n\n' % simplejson.dumps(data)
+
+
+@app.route('/events/<uuid_str>')
+def request_events(uuid_str):
+    task_id = uuid.UUID(uuid_str)
+
+    # subscribe before reading the current state so no transition is missed
+    try:
+        subscription = progress.Subscription(task_id)
+    except redis.RedisError:
+        return jsonify({'error': 'events unavailable'}), 503
+
+    db_task = database.session.query(ScrapeTask).filter_by(id=task_id).first()
+    if not db_task:
+        subscription.close()
+        return jsonify({'error': 'not found'}), 404
+
+    initial = _status_result(db_task)
+
+    # don't hold a database connection for the lifetime of the stream
+    database.session.remove()
+
+    def generate():
+        try:
+            yield 'retry: %d\n\n' % EVENTS_RETRY
+            yield _sse_event(initial)
+            if initial['status'] in progress.FINAL_STATES:
+                return
+
+            for event in subscription.iter_events(EVENTS_TIMEOUT,
+                                                  EVENTS_KEEPALIVE):
+                if event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield _sse_event(event)
+        except redis.RedisError:
+            # the client will reconnect or fall back to polling
+            pass
+        finally:
+            subscription.close()
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
 @app.route('/task', methods=['POST'])
 def request_task():
     json = request.get_json()
 
+    # fetch the task and its artifact metadata (but not content) in one query
     task_id = uuid.UUID(json['q'])
-    db_task = database.session.query(ScrapeTask).filter_by(id=task_id).first()
+    db_task = database.session.query(ScrapeTask) \
+        .options(joinedload(ScrapeTask.artifacts)) \
+        .filter_by(id=task_id).first()
     if db_task:
         if db_task.status == 'finished':
             ret = {
@@ -134,6 +486,54 @@ def request_list():
     return jsonify(results=matches)
 
 
+def _iter_file(f, start, length):
+    try:
+        f.seek(start)
+
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(blob_store.BLOB_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _not_modified(blob, etag):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since and blob.date:
+        since = request.if_modified_since.replace(tzinfo=None)
+        return blob.date.replace(microsecond=0) <= since
+
+    return False
+
+
+def _requested_range(etag, size):
+    """Find the single byte range requested by the client, if any.
+
+    :return: a tuple of (start, stop), None to send the full content, or
+             False if the range can't be satisfied
+    """
+    if not request.range or len(request.range.ranges) != 1:
+        return None
+
+    # If-Range: only honor the range if the client's copy is still current
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range.strip() != '"%s"' % etag:
+        return None
+
+    r = request.range.range_for_length(size)
+    if r is None:
+        return False
+
+    return r
+
+
 @app.route('/blob/<string:uuid_str>', methods=['GET'])
 def request_blob(uuid_str):
     blob_id = uuid.UUID(uuid_str)
@@ -142,15 +542,73 @@ def request_blob(uuid_str):
     blob = q.one_or_none()
 
     if blob:
-        headers = {'Content-Type': blob.content_type}
+        # blobs are immutable, so the content digest (or for legacy blobs,
+        # the blob's own id) is a valid strong validator
+        etag = blob.data_hash or blob.id.hex
+
+        headers = {
+            'ETag': '"%s"' % etag,
+            'Cache-Control': BLOB_CACHE_CONTROL,
+            'Accept-Ranges': 'bytes'
+        }
+        if blob.date:
+            headers['Last-Modified'] = http_date(blob.date)
+
+        if _not_modified(blob, etag):
+            return '', 304, headers
+
+        headers['Content-Type'] = blob.content_type
         if blob.content_encoding:
             headers['Content-Encoding'] = blob.content_encoding
 
-        return blob.data, 200, headers
+        if blob.data_hash:
+            store = blob_store.get_store()
+
+            rel_path = store.rel_path(blob.data_hash)
+            if BLOB_ACCEL_PREFIX and rel_path:
+                # nginx handles ranges for the redirected file itself
+                headers['X-Accel-Redirect'] = BLOB_ACCEL_PREFIX + rel_path
+                return '', 200, headers
+
+            try:
+                f = store.open(blob.data_hash)
+            except blob_store.BlobNotFoundError:
+                return jsonify({'error': 'blob data missing'}), 404
+
+            size = blob.data_size
+        else:
+            # legacy blob stored inline in the database
+            f = BytesIO(blob.data)
+            size = len(blob.data)
+
+        status = 200
+        start, stop = 0, size
+
+        r = _requested_range(etag, size)
+        if r is False:
+            f.close()
+            headers['Content-Range'] = 'bytes */%d' % size
+            return '', 416, headers
+        elif r:
+            status = 206
+            start, stop = r
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1,
+                                                           size)
+
+        headers['Content-Length'] = str(stop - start)
+        return Response(_iter_file(f, start, stop - start),
+                        status=status,
+                        headers=headers,
+                        direct_passthrough=True)
     else:
         return jsonify({'error': 'not found'}), 404
 
 
+@app.route('/metrics', methods=['GET'])
+def request_metrics():
+    return Response(metrics.generate(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     database.session.remove()
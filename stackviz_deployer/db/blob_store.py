@@ -0,0 +1,288 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import hashlib
+import os
+import tempfile
+import time
+
+from stackviz_deployer import metrics
+
+
+# the blob storage backend to use, see BACKENDS
+BLOB_STORE_BACKEND = os.environ.get('BLOB_STORE_BACKEND', 'filesystem')
+
+# root directory of the filesystem backend; must be shared by API servers and
+# workers
+BLOB_STORE_PATH = os.environ.get('BLOB_STORE_PATH', 'blobs')
+
+# the number of bytes read or written at a time
+BLOB_CHUNK_SIZE = 64 * 1024
+
+# blobs are only swept once they have been unused for this many seconds, so
+# content stored by a scrape that hasn't yet saved its rows is kept
+BLOB_SWEEP_MIN_AGE = int(os.environ.get('BLOB_SWEEP_MIN_AGE',
+                                        str(60 * 60 * 24)))
+
+
+class BlobNotFoundError(Exception):
+    """An error raised when a blob is missing from the store."""
+    pass
+
+
+class BlobStore(object):
+    """Immutable, content-addressed storage for artifact blob data."""
+
+    def put(self, fileobj):
+        """Store the contents of a file-like object.
+
+        Storing content that already exists is a no-op, so identical
+        artifacts are only stored once.
+
+        :param fileobj: a readable file-like object, read until EOF
+        :return: a tuple of (hex SHA-256 digest, size in bytes)
+        """
+        raise NotImplementedError()
+
+    def open(self, digest):
+        """Open stored content for reading.
+
+        :param digest: the hex digest returned by :meth:`put`
+        :raises BlobNotFoundError: if no such blob exists
+        :return: a readable binary file-like object
+        """
+        raise NotImplementedError()
+
+    def iter_blobs(self):
+        """List all stored blobs.
+
+        :return: a generator of (hex digest, last stored time) tuples
+        """
+        raise NotImplementedError()
+
+    def delete(self, digest, cutoff=None):
+        """Remove a blob; removing a missing blob is a no-op.
+
+        :param digest: the hex digest returned by :meth:`put`
+        :param cutoff: if set, keep the blob if it was last stored at or
+                       after this time, checked atomically with its removal
+        :return: True if the blob was removed
+        """
+        raise NotImplementedError()
+
+    def rel_path(self, digest):
+        """Return a path for the blob relative to the store's root.
+
+        This allows blobs to be served directly by a web server (e.g. using
+        nginx's X-Accel-Redirect) without passing through Python.
+
+        :param digest: the hex digest returned by :meth:`put`
+        :return: a relative path string, or None if unsupported
+        """
+        return None
+
+
+class FilesystemBlobStore(BlobStore):
+    """Stores blobs as files on a local (or shared) filesystem.
+
+    Files are named by their SHA-256 digest and fanned out into two levels of
+    subdirectories, e.g. `ab/cd/abcd...`. Content is written to a temporary
+    file and atomically renamed into place, so readers never see partial
+    blobs.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+
+    def rel_path(self, digest):
+        return '/'.join([digest[0:2], digest[2:4], digest])
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[0:2], digest[2:4], digest)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def put(self, fileobj):
+        self._makedirs(self.tmp_dir)
+
+        sha = hashlib.sha256()
+        size = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = fileobj.read(BLOB_CHUNK_SIZE)
+                    if not chunk:
+                        break
+
+                    sha.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+
+            digest = sha.hexdigest()
+            path = self._path(digest)
+
+            try:
+                # mark existing content as recently stored so sweeps don't
+                # remove it before it is referenced again
+                os.utime(path, None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+                # new (or just swept) content
+                self._makedirs(os.path.dirname(path))
+                os.chmod(tmp_path, 0o644)
+                os.rename(tmp_path, path)
+            else:
+                os.unlink(tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+            raise
+
+        return digest, size
+
+    def open(self, digest):
+        try:
+            return open(self._path(digest), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise BlobNotFoundError(digest)
+
+            raise
+
+    def iter_blobs(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                dirnames[:] = [d for d in dirnames
+                               if os.path.join(dirpath, d) != self.tmp_dir]
+                continue
+
+            for name in filenames:
+                try:
+                    mtime = os.path.getmtime(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+
+                yield name, mtime
+
+    def delete(self, digest, cutoff=None):
+        path = self._path(digest)
+
+        # move the blob aside first, so a concurrent put() either refreshes
+        # its mtime before the check below or finds it missing and stores it
+        # again
+        self._makedirs(self.tmp_dir)
+        deleted_path = os.path.join(self.tmp_dir, digest + '.deleted')
+        try:
+            os.rename(path, deleted_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+            return False
+
+        if cutoff is not None and os.path.getmtime(deleted_path) >= cutoff:
+            # stored again since it was listed; any copy stored meanwhile
+            # has the same content, so it is safe to replace
+            os.rename(deleted_path, path)
+            return False
+
+        os.unlink(deleted_path)
+        return True
+
+
+BACKENDS = {
+    'filesystem': lambda: FilesystemBlobStore(BLOB_STORE_PATH)
+}
+
+_store = None
+
+
+def get_store():
+    """Return the configured blob store.
+
+    :rtype: BlobStore
+    """
+    global _store
+
+    if _store is None:
+        _store = BACKENDS[BLOB_STORE_BACKEND]()
+
+    return _store
+
+
+def put(fileobj):
+    """Store a file-like object in the configured blob store.
+
+    :return: a tuple of (hex digest, size in bytes)
+    """
+    with metrics.time_stage('store'):
+        digest, size = get_store().put(fileobj)
+
+    metrics.ARTIFACT_BYTES.labels('stored').observe(size)
+    return digest, size
+
+
+def sweep(find_referenced, min_age=BLOB_SWEEP_MIN_AGE, batch_size=500):
+    """Delete blobs that are no longer referenced.
+
+    Rows of failed tasks are deleted without touching the store, since the
+    same content may be shared with other tasks, so unreferenced blobs are
+    expected to accumulate until swept. Blobs stored within the last
+    `min_age` seconds, including any stored again while the sweep runs, are
+    always kept.
+
+    :param find_referenced: a function taking a list of digests and returning
+                            the set of those still referenced
+    :param min_age: the minimum age in seconds of blobs to delete
+    :param batch_size: the number of digests checked at a time
+    :return: the number of blobs deleted
+    """
+    store = get_store()
+    cutoff = time.time() - min_age
+
+    def delete_unreferenced(batch):
+        referenced = find_referenced(batch)
+
+        # blobs stored again since they were listed may be referenced by rows
+        # saved after the query above, so are kept
+        return sum(1 for d in batch
+                   if d not in referenced and store.delete(d, cutoff))
+
+    deleted = 0
+    batch = []
+    for digest, mtime in store.iter_blobs():
+        if mtime >= cutoff:
+            continue
+
+        batch.append(digest)
+        if len(batch) >= batch_size:
+            deleted += delete_unreferenced(batch)
+            batch = []
+
+    if batch:
+        deleted += delete_unreferenced(batch)
+
+    return deleted
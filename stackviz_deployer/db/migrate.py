@@ -0,0 +1,111 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Upgrade an existing database to the current schema.
+
+:func:`database.init_db` only creates missing tables, so columns added to
+existing tables must be added here. Every step checks the current schema
+first, so this is safe to run repeatedly:
+
+    PYTHONPATH="." python -mstackviz_deployer.db.migrate
+"""
+
+import logging
+
+from sqlalchemy import inspect
+from sqlalchemy import text
+
+from stackviz_deployer.db import database
+from stackviz_deployer.db.models import make_url_key
+
+
+logger = logging.getLogger(__name__)
+
+# columns added since the initial schema, as (table, column, DDL) tuples
+COLUMNS = [
+    ('scrape_tasks', 'url_key',
+     'ALTER TABLE scrape_tasks ADD COLUMN url_key VARCHAR(40) NULL, '
+     'ADD UNIQUE INDEX url_key (url_key)'),
+    ('artifact_blobs', 'date',
+     'ALTER TABLE artifact_blobs ADD COLUMN date DATETIME NULL'),
+    ('artifact_blobs', 'data_hash',
+     'ALTER TABLE artifact_blobs ADD COLUMN data_hash VARCHAR(64) NULL, '
+     'ADD INDEX ix_artifact_blobs_data_hash (data_hash)'),
+    ('artifact_blobs', 'data_size',
+     'ALTER TABLE artifact_blobs ADD COLUMN data_size INTEGER NULL')
+]
+
+
+def add_columns(conn):
+    """Add any missing columns, with their indexes.
+
+    :return: a list of the (table, column) tuples added
+    """
+    inspector = inspect(conn)
+
+    added = []
+    for table, column, ddl in COLUMNS:
+        existing = [c['name'] for c in inspector.get_columns(table)]
+        if column in existing:
+            continue
+
+        logger.info('Adding column %s.%s', table, column)
+        conn.execute(text(ddl))
+        added.append((table, column))
+
+    return added
+
+
+def fill_url_keys(conn):
+    """Set `url_key` on the newest finished task of each URL.
+
+    Tasks created before `url_key` existed would otherwise never be reused,
+    so every URL would be scraped again.
+
+    :return: the number of tasks updated
+    """
+    rows = conn.execute(text(
+        "SELECT id, url FROM scrape_tasks "
+        "WHERE status = 'finished' AND url IS NOT NULL "
+        "ORDER BY date DESC"))
+
+    # keys are unique, so only the newest task of each URL gets one
+    updates = {}
+    for task_id, url in rows:
+        key = make_url_key(url)
+        if key not in updates:
+            updates[key] = {'id': task_id, 'key': key}
+
+    if updates:
+        conn.execute(text(
+            "UPDATE scrape_tasks SET url_key = :key WHERE id = :id"),
+            list(updates.values()))
+
+    return len(updates)
+
+
+def migrate():
+    database.init_db()
+
+    with database.engine.begin() as conn:
+        added = add_columns(conn)
+
+        if ('scrape_tasks', 'url_key') in added:
+            count = fill_url_keys(conn)
+            logger.info('Set url_key on %d existing tasks', count)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    migrate()
@@ -12,17 +12,29 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
+
 from datetime import datetime
 
 from sqlalchemy import (Column, ForeignKey,
                         Integer, String, DateTime, Boolean)
 from sqlalchemy.dialects.mysql import MEDIUMBLOB
+from sqlalchemy.orm import deferred
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import UUIDType
 
 from stackviz_deployer.db.database import Base
 
 
+def make_url_key(url):
+    """Create a deduplication key for a scrape URL.
+
+    :param url: the artifact listing URL
+    :return: a hex digest identifying the URL
+    """
+    return hashlib.sha1(url.strip().rstrip('/').encode('utf-8')).hexdigest()
+
+
 class ScrapeTask(Base):
     __tablename__ = 'scrape_tasks'
     __table_args__ = {'mysql_engine': 'InnoDB'}
@@ -43,6 +55,11 @@ class ScrapeTask(Base):
 
     url = Column(String(255), index=True)
 
+    # set to make_url_key(url) while the task is in-flight or finished, so at
+    # most one usable task exists per URL; cleared on error to allow retries
+    url_key = Column(String(40), unique=True)
+
+    # blob content is deferred, so loading artifacts only fetches metadata
     artifacts = relationship('ArtifactBlob')
 
 
@@ -60,5 +77,12 @@ class ArtifactBlob(Base):
     content_type = Column(String(63))
     content_encoding = Column(String(63))
     primary = Column(Boolean)
+    date = Column(DateTime, default=datetime.utcnow)
+
+    # content is kept in the blob store, addressed by its SHA-256 digest
+    data_hash = Column(String(64), index=True)
+    data_size = Column(Integer)
 
-    data = Column(MEDIUMBLOB)
+    # legacy inline content, only set for blobs created before the blob store;
+    # deferred so it is only selected when actually accessed
+    data = deferred(Column(MEDIUMBLOB))
@@ -0,0 +1,54 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+import redis
+
+
+# connection settings for redis, using docker-style ENV when available
+REDIS_HOST = os.environ.get('REDIS_PORT_6379_TCP_ADDR', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT_6379_TCP_PORT', '6379'))
+
+# the database used by celery as a broker
+REDIS_BROKER_DB = 0
+
+# the database used by celery to store task results, e.g. for chords
+REDIS_RESULT_DB = int(os.environ.get('REDIS_RESULT_DB', '2'))
+
+# the database used for shared caches
+REDIS_CACHE_DB = int(os.environ.get('REDIS_CACHE_DB', '1'))
+
+_clients = {}
+
+
+def get_url(db=REDIS_BROKER_DB):
+    return 'redis://{}:{}/{}'.format(REDIS_HOST, REDIS_PORT, db)
+
+
+def get_client(db=REDIS_CACHE_DB):
+    """Return a shared client for the given redis database.
+
+    Clients are safe to share between threads, and their connection pools
+    reconnect automatically after a fork.
+
+    :param db: the redis database number
+    :rtype: redis.StrictRedis
+    """
+    if db not in _clients:
+        _clients[db] = redis.StrictRedis(host=REDIS_HOST,
+                                         port=REDIS_PORT,
+                                         db=db)
+
+    return _clients[db]
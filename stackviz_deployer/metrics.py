@@ -0,0 +1,188 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import contextlib
+import os
+import threading
+import time
+
+from prometheus_client import CollectorRegistry
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import Counter
+from prometheus_client import generate_latest
+from prometheus_client import Histogram
+from prometheus_client import multiprocess
+from prometheus_client import REGISTRY
+from prometheus_client import start_http_server
+
+
+# if set, metrics from all processes (e.g. uwsgi and celery prefork workers)
+# are written to this directory and aggregated when scraped
+METRICS_MULTIPROC_DIR = os.environ.get(
+    'PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir'))
+
+# if set, celery workers serve metrics over HTTP on this port
+WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', '0'))
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0, 30.0, 60.0, 120.0, 300.0, float('inf'))
+
+# 1 KiB to 64 MiB in powers of 4
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9)) + (float('inf'),)
+
+COUNT_BUCKETS = (10, 100, 500, 1000, 2500, 5000, 10000, 25000, 50000,
+                 float('inf'))
+
+TASK_SECONDS = Histogram(
+    'stackviz_scrape_task_seconds',
+    'Total duration of scrape tasks',
+    ['status'], buckets=DURATION_BUCKETS)
+
+STAGE_SECONDS = Histogram(
+    'stackviz_scrape_stage_seconds',
+    'Time spent in each stage of a scrape, per artifact or operation',
+    ['stage'], buckets=DURATION_BUCKETS)
+
+SCANNER_SECONDS = Histogram(
+    'stackviz_scanner_seconds',
+    'Duration of artifact collector function calls',
+    ['function'], buckets=DURATION_BUCKETS)
+
+ARTIFACT_BYTES = Histogram(
+    'stackviz_artifact_bytes',
+    'Artifact sizes as downloaded, decompressed and stored',
+    ['stage'], buckets=SIZE_BUCKETS)
+
+SUBUNIT_TESTS = Histogram(
+    'stackviz_subunit_tests',
+    'Number of tests found per subunit artifact',
+    buckets=COUNT_BUCKETS)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    'stackviz_queue_wait_seconds',
+    'Time scrape tasks wait in their queue before a worker starts them',
+    ['queue'], buckets=DURATION_BUCKETS)
+
+ADMISSION_REJECTED = Counter(
+    'stackviz_admission_rejected_total',
+    'Scrape submissions rejected because workers are too busy',
+    ['queue'])
+
+REQUEST_SECONDS = Histogram(
+    'stackviz_api_request_seconds',
+    'Duration of API requests',
+    ['endpoint', 'method'], buckets=DURATION_BUCKETS)
+
+
+def time_stage(stage):
+    """Return a context manager observing its duration as a single stage.
+
+    :param stage: the stage name, e.g. 'listing' or 'db_commit'
+    """
+    return STAGE_SECONDS.labels(stage).time()
+
+
+class StageTimer(object):
+    """Accumulates time spent in interleaved stages of a streaming pipeline.
+
+    Downloading, decompressing, parsing and compressing an artifact happen a
+    chunk at a time, so each stage is timed per call and summed. Stages may be
+    nested, in which case the outer stage is only charged for its own time:
+    e.g. a 'parse' stage reading from a stream only counts time not already
+    spent in the nested 'download' and 'decompress' stages. Time spent in
+    :meth:`pause` (e.g. waiting on another thread) is not charged at all.
+
+    Stages may be timed from several threads; nesting is tracked per thread.
+    """
+
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+
+        # the time spent in nested stages
+        frame = [0.0]
+        stack.append(frame)
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            stack.pop()
+
+            if stack:
+                stack[-1][0] += elapsed
+
+            if name is not None:
+                with self.lock:
+                    self.totals[name] += elapsed - frame[0]
+
+    def pause(self):
+        return self.stage(None)
+
+    def observe(self):
+        """Record the accumulated time of each stage."""
+        with self.lock:
+            totals = dict(self.totals)
+
+        for name, seconds in totals.items():
+            STAGE_SECONDS.labels(name).observe(seconds)
+
+
+# custom collectors evaluated whenever metrics are scraped
+_collectors = []
+
+
+def add_collector(collector):
+    """Register a custom collector, e.g. one reading external state."""
+    _collectors.append(collector)
+
+    if not METRICS_MULTIPROC_DIR:
+        REGISTRY.register(collector)
+
+
+def get_registry():
+    """Return the registry to collect metrics from.
+
+    In multiprocess mode, this aggregates the metrics of every process
+    sharing :data:`METRICS_MULTIPROC_DIR`.
+    """
+    if METRICS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+        for collector in _collectors:
+            registry.register(collector)
+
+        return registry
+
+    return REGISTRY
+
+
+def generate():
+    """Render all metrics in the Prometheus text format."""
+    return generate_latest(get_registry())
+
+
+def start_server(port):
+    """Serve metrics over HTTP from a background thread."""
+    start_http_server(port, registry=get_registry())
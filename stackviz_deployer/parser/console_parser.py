@@ -12,9 +12,19 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import codecs
+import collections
+import hashlib
+import HTMLParser
+import json
+import logging
 import os
 import re
+import tempfile
+import threading
+import time
 
+from htmlentitydefs import name2codepoint
 from jenkins_jobs.builder import Builder
 
 
@@ -27,11 +37,30 @@ REGEX_SCP = re.compile(r'^\[SCP\] .+$')
 # Regex to match '{param}' in JJB job template names
 REGEX_JJB_TOKEN = re.compile(r'\{.+\}')
 
+# Regex to match individual '{param}' wildcards in JJB job template names
+REGEX_JJB_WILDCARD = re.compile(r'\{[\w\-]+\}')
+
+# Regex to check that a template's literal prefix has no regex metacharacters
+REGEX_JJB_LITERAL = re.compile(r'^[\w\- ]*$')
+
 REGEX_STATUS = re.compile('^Finished: (\w+)$')
 
 # Path to scan for project-config JJB yaml files
 JJB_YAML_PATH = os.environ.get('JJB_YAML_PATH', 'project-config/jenkins/jobs')
 
+# Path to a cache of job templates extracted from JJB_YAML_PATH
+JJB_CACHE_PATH = os.environ.get(
+    'JJB_CACHE_PATH',
+    os.path.join(tempfile.gettempdir(), 'stackviz-jjb-templates.json'))
+
+# Minimum number of seconds between checks for modified JJB yaml files
+JJB_CHECK_INTERVAL = int(os.environ.get('JJB_CHECK_INTERVAL', '300'))
+
+# the maximum number of job name lookups memoized by a TemplateIndex
+TEMPLATE_CACHE_SIZE = 4096
+
+logger = logging.getLogger(__name__)
+
 
 # Hack: we want to use Builder's file loading code, but we don't need a
 # Jenkins instance. (And using dummy params spams the console)
@@ -44,10 +73,6 @@ class HackBuilder(object):
         self.plugins_list = []
         self.parser = None
 
-if os.path.exists(JJB_YAML_PATH):
-    builder = HackBuilder()
-    builder.load_files([JJB_YAML_PATH])
-
 
 def job_name_matches_template(job_name, template):
     """Checks if the job name matches the job template string.
@@ -85,37 +110,369 @@ def get_builders_from_template(template):
     return scripts
 
 
+class TemplateIndex(object):
+    """A precompiled index of JJB job templates for matching job names.
+
+    Each template's regex, wildcard count and builder list is computed once.
+    Templates are bucketed by their literal prefix (the text before the first
+    wildcard), so a lookup only tests templates whose prefix the job name
+    actually starts with. Results are memoized by job name.
+
+    Matching is anchored only at the start of the name, as with
+    :func:`job_name_matches_template`, so templates can't also be bucketed by
+    suffix.
+    """
+
+    def __init__(self, templates):
+        """Build an index from a list of job templates.
+
+        :param templates: an ordered list of (template name, builder names)
+                          pairs, as returned by :func:`extract_templates`
+        """
+        # literal prefix -> list of (order, wildcard count, regex, builders)
+        self.buckets = {}
+
+        # templates whose prefix isn't a plain literal, always tested
+        self.fallback = []
+
+        for order, (name, builders) in enumerate(templates):
+            regex = re.compile(REGEX_JJB_WILDCARD.sub(r'[\w\-]*', name))
+            count = len(REGEX_JJB_WILDCARD.findall(name))
+            entry = (order, count, regex, builders)
+
+            m = REGEX_JJB_WILDCARD.search(name)
+            prefix = name[:m.start()] if m else name
+            if REGEX_JJB_LITERAL.match(prefix):
+                self.buckets.setdefault(prefix, []).append(entry)
+            else:
+                self.fallback.append(entry)
+
+        self.prefix_lengths = sorted(set(len(p) for p in self.buckets))
+        self.cache = {}
+
+    def _candidates(self, job_name):
+        for length in self.prefix_lengths:
+            if length > len(job_name):
+                break
+
+            for entry in self.buckets.get(job_name[:length], []):
+                yield entry
+
+        for entry in self.fallback:
+            yield entry
+
+    def _find(self, job_name):
+        best = None
+
+        for entry in self._candidates(job_name):
+            order, count, regex, builders = entry
+            if not regex.match(job_name):
+                continue
+
+            # since we don't know the actual variable names/values, we need
+            # to guess which match is correct
+            # minimizing the number of wildcards used ('{....}' groups) seems
+            # to eliminate a lot of otherwise incorrect choices; ties go to
+            # the first template loaded
+            if best is None or (count, order) < best[:2]:
+                best = (count, order, builders)
+
+        return best[2] if best else None
+
+    def find(self, job_name):
+        """Return the builders of the best-matching template for a job.
+
+        :param job_name: the job name to look up
+        :return: a new list of builder names, or None if no match is found
+        """
+        if job_name in self.cache:
+            builders = self.cache[job_name]
+        else:
+            builders = self._find(job_name)
+
+            if len(self.cache) >= TEMPLATE_CACHE_SIZE:
+                self.cache.clear()
+
+            self.cache[job_name] = builders
+
+        # callers consume the list, so never hand out the cached copy
+        return list(builders) if builders is not None else None
+
+
+def extract_templates(path):
+    """Load JJB yaml files and extract the builders of each job template.
+
+    :param path: the directory of JJB yaml files to load
+    :return: a list of (template name, builder names) pairs
+    """
+    builder = HackBuilder()
+    builder.load_files([path])
+
+    templates = builder.parser.data.get('job-template', {})
+    return [(name, get_builders_from_template(template))
+            for name, template in templates.iteritems()]
+
+
+def yaml_fingerprint(path):
+    """Compute a fingerprint of the JJB yaml files under a directory.
+
+    The fingerprint covers the name, size and modification time of every
+    yaml file, so any change to the tree (including added or removed files)
+    changes it, without needing to read the files themselves.
+
+    :param path: the directory of JJB yaml files
+    :return: a hex digest string
+    """
+    sha = hashlib.sha1()
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(('.yaml', '.yml')):
+                continue
+
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            sha.update('%s:%d:%r\n' % (file_path, stat.st_size,
+                                        stat.st_mtime))
+
+    return sha.hexdigest()
+
+
+def _read_cache(fingerprint):
+    try:
+        with open(JJB_CACHE_PATH, 'r') as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if cached.get('fingerprint') != fingerprint:
+        return None
+
+    return [(name, builders) for name, builders in cached['templates']]
+
+
+def _write_cache(fingerprint, templates):
+    try:
+        cache_dir = os.path.dirname(os.path.abspath(JJB_CACHE_PATH))
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'templates': templates}, f)
+
+        os.rename(tmp_path, JJB_CACHE_PATH)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write JJB template cache: %s', e)
+
+
+def load_template_index(fingerprint=None):
+    """Load a TemplateIndex, using the on-disk template cache if current.
+
+    :param fingerprint: the current yaml fingerprint, if already known
+    :return: a TemplateIndex, or None if JJB_YAML_PATH doesn't exist
+    """
+    if not os.path.exists(JJB_YAML_PATH):
+        return None
+
+    if fingerprint is None:
+        fingerprint = yaml_fingerprint(JJB_YAML_PATH)
+
+    templates = _read_cache(fingerprint)
+    if templates is None:
+        logger.info('Loading JJB templates from %s', JJB_YAML_PATH)
+        templates = extract_templates(JJB_YAML_PATH)
+        _write_cache(fingerprint, templates)
+
+    return TemplateIndex(templates)
+
+
+class _IndexState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.index = None
+        self.fingerprint = None
+        self.checked = 0
+        self.reloading = False
+
+
+_state = _IndexState()
+
+
+def _reload(fingerprint):
+    try:
+        index = load_template_index(fingerprint)
+
+        with _state.lock:
+            _state.index = index
+            _state.fingerprint = fingerprint
+    except Exception:
+        logger.exception('Failed to reload JJB templates')
+    finally:
+        with _state.lock:
+            _state.reloading = False
+
+
+def _check_for_changes():
+    # called with _state.lock held; the old index is used until the
+    # background reload finishes
+    _state.checked = time.time()
+    if _state.reloading or not os.path.exists(JJB_YAML_PATH):
+        return
+
+    fingerprint = yaml_fingerprint(JJB_YAML_PATH)
+    if fingerprint != _state.fingerprint:
+        _state.reloading = True
+
+        thread = threading.Thread(target=_reload, args=(fingerprint,),
+                                  name='jjb-reload')
+        thread.daemon = True
+        thread.start()
+
+
+def get_template_index():
+    """Return the current TemplateIndex, loading it on first use.
+
+    Nothing is loaded until a console is actually parsed. After that, the
+    yaml tree is checked for changes at most every `JJB_CHECK_INTERVAL`
+    seconds and reloaded in the background when modified.
+
+    :return: a TemplateIndex, or None if no JJB yaml files are available
+    """
+    with _state.lock:
+        if not _state.loaded:
+            if os.path.exists(JJB_YAML_PATH):
+                _state.fingerprint = yaml_fingerprint(JJB_YAML_PATH)
+                _state.index = load_template_index(_state.fingerprint)
+
+            _state.loaded = True
+            _state.checked = time.time()
+        elif time.time() - _state.checked > JJB_CHECK_INTERVAL:
+            _check_for_changes()
+
+        return _state.index
+
+
 def get_job_builders(job_name):
     """Return a list of JJB builder names for the given job.
 
     :param job_name: the job name to look up
     :return: a list of builder names, or None if not match is found
     """
-    if not builder:
+    index = get_template_index()
+    if not index:
         return None
 
-    templates = builder.parser.data['job-template']
+    return index.find(job_name)
 
-    # tuples of (template, wildcard count)
-    matches = []
 
-    for name, template in templates.iteritems():
-        if job_name_matches_template(job_name, name):
-            count = len(re.findall(r'\{[\w\-]+\}', name))
-            matches.append((template, count))
+class ConsoleTextReader(HTMLParser.HTMLParser):
+    """Incrementally extracts the lines of the first <pre> in a console page.
 
-    if not matches:
-        return None
+    Raw HTML is fed in chunks (e.g. straight from an HTTP response) and
+    iterating yields each unescaped line of the <pre> element's text as soon
+    as it's complete, without building a document tree. Only the current
+    partial line is buffered. Input is no longer consumed once the closing
+    </pre> tag is seen.
+    """
 
-    # since we don't know the actual variable names/values, we need to guess
-    # which match is correct
-    # minimizing the number of wildcards used ('{....}' groups) seems to
-    # eliminate a lot of otherwise incorrect choices
-    best = sorted(matches, key=lambda e: e[1])
-    return get_builders_from_template(best[0][0])
+    def __init__(self, chunks, encoding='utf-8'):
+        HTMLParser.HTMLParser.__init__(self)
+        self.chunks = chunks
+        self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+
+        #: True once the start of a <pre> element has been seen
+        self.found = False
+
+        self.in_pre = False
+        self.done = False
+        self.partial = []
+        self.lines = collections.deque()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'pre' and not self.found:
+            self.found = True
+            self.in_pre = True
+
+    def handle_endtag(self, tag):
+        if tag == 'pre' and self.in_pre:
+            self.in_pre = False
+            self.done = True
+            self._end_line(final=True)
+
+    def handle_data(self, data):
+        if self.in_pre:
+            self._append(data)
+
+    def handle_entityref(self, name):
+        if self.in_pre:
+            if name in name2codepoint:
+                self._append(unichr(name2codepoint[name]))
+            else:
+                self._append(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        if self.in_pre:
+            try:
+                if name[:1] in ('x', 'X'):
+                    self._append(unichr(int(name[1:], 16)))
+                else:
+                    self._append(unichr(int(name)))
+            except (ValueError, OverflowError):
+                self._append(u'&#%s;' % name)
+
+    def _append(self, text):
+        parts = text.split('\n')
+        self.partial.append(parts[0])
+
+        for part in parts[1:]:
+            self._end_line()
+            self.partial.append(part)
+
+    def _end_line(self, final=False):
+        line = u''.join(self.partial).rstrip(u'\r')
+        self.partial = []
+
+        # as with splitlines(), text ending in a newline has no extra line
+        if line or not final:
+            self.lines.append(line)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.feed(self.decoder.decode(chunk))
+
+            while self.lines:
+                yield self.lines.popleft()
+
+            if self.done:
+                return
+
+        self.feed(self.decoder.decode('', final=True))
+        self.close()
+        self._end_line(final=True)
+
+        while self.lines:
+            yield self.lines.popleft()
 
 
 def parse_console(text):
+    """Parse the full text of a console log.
+
+    :param text: the console text
+    :return: a dict of the job status, script sections and their lines
+    """
+    return parse_console_lines(text.splitlines())
+
+
+def parse_console_lines(lines):
+    """Parse a console log given as an iterable of lines.
+
+    Lines are consumed one at a time, so `lines` may be a generator such as a
+    :class:`ConsoleTextReader`. Iteration stops at the job's final status
+    line.
+
+    :param lines: an iterable of console lines
+    :return: a dict of the job status, script sections and their lines
+    """
     script_names = None
     scripts = []
 
@@ -125,7 +482,7 @@ def parse_console(text):
 
     status = None
 
-    for raw_line in text.splitlines():
+    for raw_line in lines:
         if ' | ' not in raw_line:
             continue
 
@@ -12,12 +12,18 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import calendar
+import contextlib
 import os
+import Queue
 import re
 import shutil
 import subunit
 import sys
+import threading
 
+from array import array
 from functools import partial
 from io import BytesIO
 
@@ -33,11 +39,34 @@ from testrepository.repository.file import RepositoryNotFound
 NAME_SCENARIO_PATTERN = re.compile(r'^(.+) \((.+)\)$')
 NAME_TAGS_PATTERN = re.compile(r'^(.+)\[(.+)\]$')
 
+# the maximum number of converted tests buffered between the parser thread
+# and the consumer of iter_stream()
+STREAM_BUFFER_SIZE = 64
+
+_STREAM_RECORD = 'record'
+_STREAM_ERROR = 'error'
+_STREAM_END = 'end'
+
+# the version of the compact result format produced by CompactResults
+COMPACT_FORMAT_VERSION = 1
+
+# test statuses as reported by testtools; compact results store the index
+STATUS_NAMES = ['success', 'fail', 'skip', 'xfail', 'uxsuccess', 'exists',
+                'inprogress', 'unknown']
+
+# element types of arrays in compact results, by array typecode
+_DTYPES = {'B': 'uint8', 'I': 'uint32', 'd': 'float64'}
+
 
 class InvalidSubunitProvider(Exception):
     pass
 
 
+class _StreamAborted(Exception):
+    """Raised in the parser thread when the consumer stops iterating."""
+    pass
+
+
 class SubunitProvider(object):
     @property
     def name(self):
@@ -226,37 +255,30 @@ def _clean_details(details):
             if v.as_text()}
 
 
-def _read_test(test, out, strip_details):
+def _convert_test(test, strip_details):
     # clean up the result test info a bit
 
     start, end = test['timestamps']
 
-    out.append({
+    return {
         'name': _clean_name(test['id']),
         'status': test['status'],
         'tags': list(test['tags']),
         'timestamps': test['timestamps'],
         'duration': (end - start).total_seconds(),
         'details': {} if strip_details else _clean_details(test['details'])
-    })
-
+    }
 
-def convert_stream(stream_file, strip_details=False):
-    """Converts a subunit stream into a raw list of test dicts.
 
-    :param stream_file: subunit stream to be converted
-    :param strip_details: if True, remove test details (e.g. stdout/stderr)
-    :return: a list of individual test results
-    """
+def _read_test(test, out, strip_details):
+    out.append(_convert_test(test, strip_details))
 
-    ret = []
 
+def _run_stream(stream_file, callback):
     result_stream = subunit.ByteStreamToStreamResult(stream_file)
     starts = StreamResult()
     summary = StreamSummary()
-    outcomes = StreamToDict(partial(_read_test,
-                                    out=ret,
-                                    strip_details=strip_details))
+    outcomes = StreamToDict(callback)
 
     result = CopyStreamResult([starts, outcomes, summary])
 
@@ -264,9 +286,228 @@ def convert_stream(stream_file, strip_details=False):
     result_stream.run(result)
     result.stopTestRun()
 
+
+def convert_stream(stream_file, strip_details=False):
+    """Converts a subunit stream into a raw list of test dicts.
+
+    :param stream_file: subunit stream to be converted
+    :param strip_details: if True, remove test details (e.g. stdout/stderr)
+    :return: a list of individual test results
+    """
+
+    ret = []
+
+    _run_stream(stream_file, partial(_read_test,
+                                     out=ret,
+                                     strip_details=strip_details))
+
     return ret
 
 
+@contextlib.contextmanager
+def _untimed(name=None):
+    yield
+
+
+def iter_stream(stream_file, strip_details=False, timer=None):
+    """Converts a subunit stream into test dicts, yielding each as it ends.
+
+    Unlike :func:`convert_stream`, results are never collected into a list.
+    The stream is parsed in a background thread which hands each test to the
+    caller as soon as `StreamToDict` completes it, blocking once
+    `STREAM_BUFFER_SIZE` tests are waiting to be consumed. Errors raised while
+    parsing are re-raised from this generator.
+
+    :param stream_file: subunit stream to be converted
+    :param strip_details: if True, remove test details (e.g. stdout/stderr)
+    :param timer: an optional `stackviz_deployer.metrics.StageTimer`, charged
+                  with 'parse' time in the background thread (excluding time
+                  blocked on a full buffer)
+    :return: a generator of individual test results
+    """
+    buf = Queue.Queue(maxsize=STREAM_BUFFER_SIZE)
+    aborted = threading.Event()
+
+    stage = timer.stage if timer else _untimed
+    pause = timer.pause if timer else _untimed
+
+    def put(item):
+        # never block forever: the consumer may have gone away
+        with pause():
+            while True:
+                if aborted.is_set():
+                    raise _StreamAborted()
+
+                try:
+                    buf.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    continue
+
+    def on_test(test):
+        put((_STREAM_RECORD, _convert_test(test, strip_details)))
+
+    def produce():
+        try:
+            with stage('parse'):
+                _run_stream(stream_file, on_test)
+
+            put((_STREAM_END, None))
+        except _StreamAborted:
+            pass
+        except Exception as e:
+            try:
+                put((_STREAM_ERROR, e))
+            except _StreamAborted:
+                pass
+
+    thread = threading.Thread(target=produce, name='subunit-parser')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            kind, value = buf.get()
+            if kind == _STREAM_END:
+                break
+            elif kind == _STREAM_ERROR:
+                raise value
+
+            yield value
+    finally:
+        aborted.set()
+
+
+def _epoch_micros(dt):
+    return calendar.timegm(dt.utctimetuple()) * 1000000 + dt.microsecond
+
+
+def _encode_array(values):
+    # typed arrays are always little-endian, as read by JS typed arrays on
+    # all common platforms
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return {
+        'dtype': _DTYPES[values.typecode],
+        'data': base64.b64encode(values.tostring())
+    }
+
+
+class CompactResults(object):
+    """Array-backed storage for converted test results.
+
+    Tests are added one at a time (e.g. from :func:`iter_stream`) and stored
+    in parallel typed arrays rather than as dicts:
+
+    * test names are split into a prefix (e.g. the module and class) and
+      suffix (e.g. the method name), each interned in a shared string table
+    * each test's set of tags is interned as a list of string table indexes
+    * statuses are stored as indexes into `STATUS_NAMES`
+    * start and end timestamps are stored as float64 arrays of whole
+      microseconds (JS has no practical 64-bit integer typed array, and
+      float64 represents integers exactly up to 2^53), encoded as offsets
+      from the earliest start time
+
+    Test details are not stored.
+    """
+
+    __slots__ = ('strings', 'string_ids', 'tag_sets', 'tag_set_ids',
+                 'name_prefixes', 'name_suffixes', 'statuses', 'tags',
+                 'starts', 'ends')
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.tag_sets = []
+        self.tag_set_ids = {}
+
+        self.name_prefixes = array('I')
+        self.name_suffixes = array('I')
+        self.statuses = array('B')
+        self.tags = array('I')
+
+        # whole microseconds since epoch, as float64
+        self.starts = array('d')
+        self.ends = array('d')
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def _intern(self, string):
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(string)
+            self.string_ids[string] = string_id
+
+        return string_id
+
+    def _intern_tags(self, tags):
+        key = tuple(sorted(self._intern(t) for t in tags))
+
+        tag_set_id = self.tag_set_ids.get(key)
+        if tag_set_id is None:
+            tag_set_id = len(self.tag_sets)
+            self.tag_sets.append(list(key))
+            self.tag_set_ids[key] = tag_set_id
+
+        return tag_set_id
+
+    def add(self, test):
+        """Add a converted test result.
+
+        :param test: a test dict, as produced by :func:`convert_stream`
+        """
+        prefix, _, suffix = test['name'].rpartition('.')
+        if prefix:
+            prefix += '.'
+
+        if test['status'] in STATUS_NAMES:
+            status = STATUS_NAMES.index(test['status'])
+        else:
+            status = STATUS_NAMES.index('unknown')
+
+        start, end = test['timestamps']
+
+        self.name_prefixes.append(self._intern(prefix))
+        self.name_suffixes.append(self._intern(suffix))
+        self.statuses.append(status)
+        self.tags.append(self._intern_tags(test['tags']))
+        self.starts.append(_epoch_micros(start))
+        self.ends.append(_epoch_micros(end))
+
+    def to_dict(self):
+        """Encode the results as a JSON-serializable dict.
+
+        Arrays are encoded as `{'dtype': ..., 'data': ...}` where `data` is
+        the base64 encoding of the little-endian array contents, suitable
+        for loading directly into JS typed arrays. `start` and `end` are
+        float64 arrays of whole microseconds relative to `base`, itself an
+        integer number of microseconds since epoch.
+        A test's name is `strings[name_prefix[i]] + strings[name_suffix[i]]`
+        and its tags are `tag_sets[tags[i]]`, as string table indexes.
+        """
+        base = min(self.starts) if self.starts else 0
+
+        return {
+            'version': COMPACT_FORMAT_VERSION,
+            'count': len(self),
+            'base': int(base),
+            'strings': self.strings,
+            'status_names': STATUS_NAMES,
+            'tag_sets': self.tag_sets,
+            'name_prefix': _encode_array(self.name_prefixes),
+            'name_suffix': _encode_array(self.name_suffixes),
+            'status': _encode_array(self.statuses),
+            'tags': _encode_array(self.tags),
+            'start': _encode_array(array('d', (t - base
+                                               for t in self.starts))),
+            'end': _encode_array(array('d', (t - base for t in self.ends)))
+        }
+
+
 def convert_run(test_run, strip_details=False):
     """Converts the given test run into a raw list of test dicts.
 
@@ -12,11 +12,33 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import codecs
 import fnmatch
+import HTMLParser
+import os
+import threading
 import urlparse
 
-import bs4
-import requests
+from htmlentitydefs import name2codepoint
+
+import cache
+import http_pool
+
+from stackviz_deployer import metrics
+
+
+# the number of parsed listings to keep in memory, per process
+LISTING_CACHE_SIZE = int(os.environ.get('LISTING_CACHE_SIZE', '512'))
+
+# the number of seconds a parsed listing is reused before being fetched again
+LISTING_CACHE_TTL = float(os.environ.get('LISTING_CACHE_TTL', '300'))
+
+# 'memory' for a per-process cache only, or 'redis' to also share parsed
+# listings between processes
+LISTING_CACHE_BACKEND = os.environ.get('LISTING_CACHE_BACKEND', 'memory')
+
+# the number of bytes of a listing parsed at a time
+LISTING_CHUNK_SIZE = 16 * 1024
 
 
 class InvalidArtifactError(Exception):
@@ -34,6 +56,10 @@ class Artifact(object):
         self.name = name
 
         self.browse_cache = None
+        self.browse_lock = threading.Lock()
+
+        # if already downloaded, the spool returned by fetch.spool_artifact
+        self.spool = None
 
         if self.name.endswith('/'):
             self.name = self.name[:-1]
@@ -52,8 +78,10 @@ class Artifact(object):
             raise InvalidArtifactError(
                 'Cannot browse a non-directory artifact.')
 
-        if not self.browse_cache:
-            self.browse_cache = DirectoryListing(self.abs_url())
+        # may be called concurrently, e.g. by the crawler and a scanner
+        with self.browse_lock:
+            if not self.browse_cache:
+                self.browse_cache = DirectoryListing(self.abs_url())
 
         return self.browse_cache
 
@@ -67,6 +95,163 @@ class Artifact(object):
         )
 
 
+class ListingParser(HTMLParser.HTMLParser):
+    """A streaming parser for Apache 2 directory listing pages.
+
+    Each table row's first icon gives the entry type (its alt text, e.g.
+    '[DIR]'), and each link within a table cell gives an entry's URL and
+    name. No document tree is built: rows are emitted to :attr:`entries` as
+    they end, so the page can be fed in chunks as it is downloaded.
+    """
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+
+        #: a list of (rel_url, entry_type, name) tuples
+        self.entries = []
+
+        self.in_row = False
+        self.cell_depth = 0
+        self.row_type = None
+        self.row_links = []
+
+        # [href, list of text fragments] of the link being read, if any
+        self.link = None
+
+    def _end_row(self):
+        if self.in_row and self.row_type is not None:
+            for href, text in self.row_links:
+                self.entries.append((href, self.row_type, u''.join(text)))
+
+        self.in_row = False
+        self.cell_depth = 0
+        self.row_type = None
+        self.row_links = []
+        self.link = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            # rows may be left unclosed
+            self._end_row()
+            self.in_row = True
+        elif not self.in_row:
+            return
+        elif tag == 'td':
+            self.cell_depth += 1
+        elif self.cell_depth == 0:
+            return
+        elif tag == 'img':
+            if self.row_type is None:
+                self.row_type = dict(attrs).get('alt')
+        elif tag == 'a':
+            href = dict(attrs).get('href')
+            if href is not None:
+                self.link = [href, []]
+                self.row_links.append(self.link)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'tr' or tag == 'table':
+            self._end_row()
+        elif tag == 'td' and self.cell_depth > 0:
+            self.cell_depth -= 1
+            self.link = None
+        elif tag == 'a':
+            self.link = None
+
+    def handle_data(self, data):
+        if self.link is not None:
+            self.link[1].append(data)
+
+    def handle_entityref(self, name):
+        if self.link is not None:
+            if name in name2codepoint:
+                self.link[1].append(unichr(name2codepoint[name]))
+            else:
+                self.link[1].append(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        if self.link is not None:
+            try:
+                if name[:1] in ('x', 'X'):
+                    self.link[1].append(unichr(int(name[1:], 16)))
+                else:
+                    self.link[1].append(unichr(int(name)))
+            except (ValueError, OverflowError):
+                self.link[1].append(u'&#%s;' % name)
+
+    def close(self):
+        HTMLParser.HTMLParser.close(self)
+        self._end_row()
+
+
+def fetch_entries(url):
+    """Download and parse a directory listing.
+
+    :param url: the URL of the listing
+    :return: a list of (rel_url, entry_type, name) tuples
+    """
+    with metrics.time_stage('listing'):
+        with http_pool.stream(url) as r:
+            r.raise_for_status()
+
+            # decode explicitly: iter_content() yields raw bytes when the
+            # server doesn't declare a charset
+            try:
+                decoder_cls = codecs.getincrementaldecoder(
+                    r.encoding or 'utf-8')
+            except LookupError:
+                decoder_cls = codecs.getincrementaldecoder('utf-8')
+
+            decoder = decoder_cls(errors='replace')
+
+            parser = ListingParser()
+            for chunk in r.iter_content(LISTING_CHUNK_SIZE):
+                parser.feed(decoder.decode(chunk))
+
+            parser.feed(decoder.decode(b'', final=True))
+            parser.close()
+
+    return parser.entries
+
+
+_local_cache = cache.LRUCache(LISTING_CACHE_SIZE, LISTING_CACHE_TTL)
+
+if LISTING_CACHE_BACKEND == 'redis':
+    _shared_cache = cache.RedisCache('stackviz:listing', LISTING_CACHE_TTL)
+else:
+    _shared_cache = None
+
+
+def get_entries(url):
+    """Return the parsed entries of a directory listing, reusing cached ones.
+
+    Parsed listings are kept in a per-process LRU cache for
+    `LISTING_CACHE_TTL` seconds and, if `LISTING_CACHE_BACKEND` is 'redis',
+    shared with other processes for the same duration.
+
+    :param url: the URL of the listing
+    :return: a list of (rel_url, entry_type, name) tuples
+    """
+    entries = _local_cache.get(url)
+    if entries is not None:
+        return entries
+
+    if _shared_cache is not None:
+        entries = _shared_cache.get(url)
+
+    if entries is None:
+        entries = fetch_entries(url)
+
+        if _shared_cache is not None:
+            _shared_cache.set(url, entries)
+
+    _local_cache.set(url, entries)
+    return entries
+
+
 class DirectoryListing(object):
     """A navigator for Apache 2 directory listings."""
 
@@ -76,17 +261,7 @@ class DirectoryListing(object):
         self.files = []
         self.directories = []
 
-        response = requests.get(url)
-        response.raise_for_status()
-
-        soup = bs4.BeautifulSoup(response.text)
-        items = soup.select('tr td a')
-
-        for item in items:
-            rel_url = item.attrs['href']
-            entry_type = item.parent.parent.select('td img')[0].attrs['alt']
-            name = item.text
-
+        for rel_url, entry_type, name in get_entries(url):
             artifact = Artifact(self.url, rel_url, entry_type, name)
             if artifact.is_dir():
                 self.directories.append(artifact)
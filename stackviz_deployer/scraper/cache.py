@@ -0,0 +1,137 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+import threading
+import time
+
+import redis
+import simplejson
+
+from stackviz_deployer.db import redis_conn
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded LRU cache with per-entry expiry.
+
+    Expired entries are not removed on lookup, so callers can still
+    revalidate and reuse stale values (see :meth:`lookup`). They are only
+    dropped when evicted to make room for newer entries.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """Find an entry, whether or not it has expired.
+
+        :param key: the key to look up
+        :return: a tuple of (value, fresh), or (None, False) if not cached
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None, False
+
+            # re-insert to mark as most recently used
+            self.entries[key] = entry
+
+            expires, value = entry
+            return value, time.time() < expires
+
+    def get(self, key):
+        """Return the cached value for the key if it hasn't expired.
+
+        :param key: the key to look up
+        :return: the cached value, or None
+        """
+        value, fresh = self.lookup(key)
+        return value if fresh else None
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisCache(object):
+    """A JSON-serialized cache in redis, shared between processes.
+
+    Redis errors are logged and treated as cache misses so an unavailable
+    redis server only costs performance.
+    """
+
+    def __init__(self, prefix, ttl, client=None):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.client = client
+
+    def _client(self):
+        if self.client is None:
+            self.client = redis_conn.get_client()
+
+        return self.client
+
+    def _key(self, key):
+        return '%s:%s' % (self.prefix, key)
+
+    def get(self, key):
+        try:
+            raw = self._client().get(self._key(key))
+        except redis.RedisError as e:
+            logger.warning('Redis cache get failed: %s', e)
+            return None
+
+        if raw is None:
+            return None
+
+        return simplejson.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        try:
+            self._client().setex(self._key(key), int(max(ttl, 1)),
+                                 simplejson.dumps(value))
+        except redis.RedisError as e:
+            logger.warning('Redis cache set failed: %s', e)
+
+    def delete(self, key):
+        try:
+            self._client().delete(self._key(key))
+        except redis.RedisError as e:
+            logger.warning('Redis cache delete failed: %s', e)
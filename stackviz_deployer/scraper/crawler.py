@@ -0,0 +1,130 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import fnmatch
+import logging
+import os
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+# the maximum depth of subdirectories crawled below a task's root listing
+CRAWL_MAX_DEPTH = int(os.environ.get('CRAWL_MAX_DEPTH', '3'))
+
+# the maximum number of directory listings fetched concurrently
+CRAWL_CONCURRENCY = int(os.environ.get('CRAWL_CONCURRENCY', '8'))
+
+# the maximum number of directories listed per crawl, including the root
+CRAWL_MAX_DIRECTORIES = int(os.environ.get('CRAWL_MAX_DIRECTORIES', '100'))
+
+# comma-separated glob patterns of directory names that are never entered;
+# by default, large config and report trees that contain no artifacts
+CRAWL_PRUNE = os.environ.get(
+    'CRAWL_PRUNE',
+    'etc,ara,ara-report,stackviz,apache,apache_config,sudoers.d,libvirt')
+
+
+def _default_prune():
+    return [p.strip() for p in CRAWL_PRUNE.split(',') if p.strip()]
+
+
+def _is_child(directory, root_url):
+    # skip links leaving the tree, e.g. 'Parent Directory'
+    url = directory.abs_url()
+    return url.startswith(root_url) and len(url) > len(root_url)
+
+
+def _browse(directory):
+    try:
+        return directory.browse()
+    except requests.RequestException as e:
+        logger.warning('Could not list %s: %s', directory.abs_url(), e)
+        return None
+
+
+def crawl(listing, max_depth=CRAWL_MAX_DEPTH, prune=None,
+          concurrency=CRAWL_CONCURRENCY,
+          max_directories=CRAWL_MAX_DIRECTORIES):
+    """Walk a directory tree breadth-first, listing each level concurrently.
+
+    The root listing is yielded first at depth 0, followed by each of its
+    subdirectories at depth 1, and so on. All subdirectories of one level are
+    listed in parallel (using at most `concurrency` threads) before moving on
+    to the next. Subdirectories that can't be listed are logged and skipped.
+
+    :param listing: the root directory listing
+    :type listing: stackviz_deployer.scraper.artifacts_list.DirectoryListing
+    :param max_depth: the deepest level of subdirectories to list
+    :param prune: glob patterns of directory names never to enter, or None
+                  to use `CRAWL_PRUNE`
+    :param concurrency: the maximum number of concurrent listing requests
+    :param max_directories: the maximum number of directories to list
+    :return: a generator of (DirectoryListing, depth) tuples
+    """
+    if prune is None:
+        prune = _default_prune()
+
+    root_url = listing.url
+    if not root_url.endswith('/'):
+        root_url += '/'
+
+    seen = set([root_url])
+    remaining = max_directories - 1
+
+    level = [listing]
+    depth = 0
+
+    pool = None
+    try:
+        while level:
+            for directory in level:
+                yield directory, depth
+
+            if depth >= max_depth or remaining <= 0:
+                break
+
+            children = []
+            for directory in level:
+                for child in directory.directories:
+                    url = child.abs_url()
+                    if url in seen or not _is_child(child, root_url):
+                        continue
+
+                    if any(fnmatch.fnmatch(child.name, p) for p in prune):
+                        continue
+
+                    seen.add(url)
+                    children.append(child)
+
+            if len(children) > remaining:
+                logger.warning('Directory limit reached crawling %s',
+                               root_url)
+                children = children[:remaining]
+
+            remaining -= len(children)
+            if not children:
+                break
+
+            if pool is None:
+                pool = ThreadPool(max(1, concurrency))
+
+            level = [c for c in pool.map(_browse, children) if c is not None]
+            depth += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
@@ -13,17 +13,33 @@
 # under the License.
 
 import collections
+import os
 import re
+import time
 
-import requests
 import simplejson
 
 import artifacts_list
+import cache
+import http_pool
 
 
 API_BASE = 'https://review.openstack.org/'
 API_CHANGES = API_BASE + 'changes/'
 
+# the number of parsed changes to keep in memory, per process
+GERRIT_CACHE_SIZE = int(os.environ.get('GERRIT_CACHE_SIZE', '256'))
+
+# the number of seconds a cached change is used before being revalidated
+GERRIT_CACHE_TTL = float(os.environ.get('GERRIT_CACHE_TTL', '60'))
+
+# the number of seconds stale changes are kept in redis for revalidation
+GERRIT_CACHE_STALE_TTL = 60 * 60 * 24
+
+# 'memory' for a per-process cache only, or 'redis' to also share fetched
+# changes between processes
+GERRIT_CACHE_BACKEND = os.environ.get('GERRIT_CACHE_BACKEND', 'memory')
+
 #: A list of (id, username) tuples of CI accounts we can parse messages for
 CI_ACCOUNT_IDS = [(3, 'jenkins')]
 
@@ -122,23 +138,61 @@ class CIMessage(object):
         )
 
 
+def _load_json(response):
+    # gerrit API outputs junk on first line to prevent XSSI, remove it
+    raw_json = '\n'.join(response.text.splitlines()[1:])
+
+    return simplejson.loads(raw_json)
+
+
+def fetch_change(change_id, etag=None):
+    """Fetch the ChangeInfo entity, with messages, for a change.
+
+    :param change_id: the change number to fetch
+    :param etag: if set, only fetch the change if its ETag no longer matches
+    :return: a tuple of (change dict, etag); the change is None if the
+             given ETag is still valid
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+
+    response = http_pool.get(API_CHANGES + str(change_id) + '/detail',
+                             headers=headers)
+    if response.status_code == 304:
+        return None, etag
+
+    response.raise_for_status()
+
+    return _load_json(response), response.headers.get('etag')
+
+
+def fetch_updated(change_id):
+    """Fetch only the last-updated timestamp of a change.
+
+    :param change_id: the change number to fetch
+    :return: the change's 'updated' timestamp string
+    """
+    response = http_pool.get(API_CHANGES + str(change_id))
+    response.raise_for_status()
+
+    return _load_json(response).get('updated')
+
+
 class GerritListing(object):
     """Extracts Jenkins build artifact URLs from Gerrit comments."""
 
-    def __init__(self, change_id):
+    def __init__(self, change_id, change=None):
         self.change_id = change_id
 
         self.revisions = collections.OrderedDict()
 
-        response = requests.get(API_CHANGES + str(change_id) + '/detail')
-        response.raise_for_status()
-
-        # gerrit API outputs junk on first line to prevent XSSI, remove it
-        raw_json = '\n'.join(response.text.splitlines()[1:])
+        if change is None:
+            change, _ = fetch_change(change_id)
 
-        change = simplejson.loads(raw_json)
         self.change_project = change['project']
         self.change_subject = change['subject']
+        self.change_updated = change.get('updated')
 
         for i, message in enumerate(change['messages']):
             # ignore author-less CI messages ("change has been merged", etc)
@@ -183,3 +237,84 @@ class GerritListing(object):
             self.change_id,
             ', '.join(map(str, self.revisions.keys()))
         )
+
+
+#: A cached listing along with the validators needed to revalidate it
+_CacheEntry = collections.namedtuple('_CacheEntry',
+                                     ['listing', 'etag', 'updated'])
+
+_local_cache = cache.LRUCache(GERRIT_CACHE_SIZE, GERRIT_CACHE_TTL)
+
+if GERRIT_CACHE_BACKEND == 'redis':
+    _shared_cache = cache.RedisCache('stackviz:gerrit', GERRIT_CACHE_STALE_TTL)
+else:
+    _shared_cache = None
+
+
+def _revalidate(change_id, entry):
+    if entry is not None:
+        if entry.etag:
+            change, etag = fetch_change(change_id, entry.etag)
+            if change is None:
+                return entry
+        elif entry.updated and fetch_updated(change_id) == entry.updated:
+            return entry
+        else:
+            change, etag = fetch_change(change_id)
+    else:
+        change, etag = fetch_change(change_id)
+
+    entry = _CacheEntry(GerritListing(change_id, change),
+                        etag,
+                        change.get('updated'))
+
+    if _shared_cache is not None:
+        _shared_cache.set(change_id, {
+            'time': time.time(),
+            'etag': etag,
+            'updated': entry.updated,
+            'change': change
+        })
+
+    return entry
+
+
+def get_listing(change_id):
+    """Return a GerritListing for the change, reusing cached results.
+
+    Parsed listings are kept in a per-process LRU cache for
+    `GERRIT_CACHE_TTL` seconds. Once expired, a listing is revalidated with
+    the change's ETag (or its 'updated' timestamp if Gerrit sent no ETag)
+    and only fetched and parsed again if the change was modified. If
+    `GERRIT_CACHE_BACKEND` is 'redis', fetched changes are also shared with
+    other processes.
+
+    Cached listings are shared between callers and must not be modified.
+
+    :param change_id: the change number to look up
+    :rtype: GerritListing
+    """
+    change_id = int(change_id)
+
+    entry, fresh = _local_cache.lookup(change_id)
+    if fresh:
+        return entry.listing
+
+    if _shared_cache is not None:
+        shared = _shared_cache.get(change_id)
+        if shared is not None:
+            if entry is None or entry.updated != shared['updated']:
+                entry = _CacheEntry(
+                    GerritListing(change_id, shared['change']),
+                    shared['etag'],
+                    shared['updated'])
+
+            age = time.time() - shared['time']
+            if age < GERRIT_CACHE_TTL:
+                _local_cache.set(change_id, entry, GERRIT_CACHE_TTL - age)
+                return entry.listing
+
+    entry = _revalidate(change_id, entry)
+    _local_cache.set(change_id, entry)
+
+    return entry.listing
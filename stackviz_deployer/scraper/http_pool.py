@@ -0,0 +1,147 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import os
+import threading
+import urlparse
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+# the number of distinct hosts to keep connection pools for
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '10'))
+
+# the maximum number of idle keep-alive connections kept per host
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '16'))
+
+# the maximum number of concurrent requests to any single host
+HTTP_HOST_CONCURRENCY = int(os.environ.get('HTTP_HOST_CONCURRENCY', '8'))
+
+# retry settings for failed connections and 5xx responses; sleeps between
+# attempts grow as backoff * 2^(attempt - 1)
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '3'))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', '0.5'))
+HTTP_RETRY_STATUSES = [500, 502, 503, 504]
+
+# connect/read timeout, in seconds
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '30'))
+
+_lock = threading.Lock()
+_pid = None
+_session = None
+_host_limits = {}
+
+
+def _check_pid():
+    # sessions (and their sockets) must not be shared with forked children,
+    # e.g. celery prefork workers, so start fresh in each new process
+    global _pid, _session, _host_limits
+
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _session = None
+        _host_limits = {}
+
+
+def _create_session():
+    # once retries are exhausted, return the last error response rather than
+    # raising RetryError, so callers still see it via raise_for_status()
+    retry = Retry(total=HTTP_RETRIES,
+                  backoff_factor=HTTP_BACKOFF,
+                  status_forcelist=HTTP_RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                          pool_maxsize=HTTP_POOL_MAXSIZE,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def get_session():
+    """Return the process-wide pooled session, creating it if needed.
+
+    :rtype: requests.Session
+    """
+    global _session
+
+    with _lock:
+        _check_pid()
+
+        if _session is None:
+            _session = _create_session()
+
+        return _session
+
+
+def _host_limit(url):
+    host = urlparse.urlparse(url).netloc
+
+    with _lock:
+        _check_pid()
+
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(
+                HTTP_HOST_CONCURRENCY)
+
+        return _host_limits[host]
+
+
+def get(url, **kwargs):
+    """Perform a GET request using the shared session.
+
+    The response body is read fully before returning so that the connection
+    is released back to the pool and the per-host limit is not held by the
+    caller.
+
+    :param url: the URL to fetch
+    :param kwargs: extra arguments for `requests.Session.get`
+    :rtype: requests.Response
+    """
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+
+    with _host_limit(url):
+        response = get_session().get(url, **kwargs)
+
+        # noinspection PyStatementEffect
+        response.content
+
+    return response
+
+
+@contextlib.contextmanager
+def stream(url, **kwargs):
+    """Open a streaming GET request using the shared session.
+
+    The per-host concurrency limit is held until the context exits, at which
+    point the response is closed and its connection returned to the pool.
+
+    :param url: the URL to fetch
+    :param kwargs: extra arguments for `requests.Session.get`
+    """
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+
+    with _host_limit(url):
+        response = get_session().get(url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            response.close()
@@ -51,7 +51,7 @@ def _create_job(name=None, url=None, status=None):
 
 
 def _gerrit_urls_filtered(change_id, revision=None):
-    listing = gerrit_list.GerritListing(change_id)
+    listing = gerrit_list.get_listing(change_id)
 
     if revision is None:
         # default to the most recent revision
@@ -165,7 +165,7 @@ def get_matching_artifact_urls(user_input):
         if 'change_id' in parsed_artifact_info:
             # try to fetch the gerrit change to fill in missing details
             try:
-                listing = gerrit_list.GerritListing(
+                listing = gerrit_list.get_listing(
                     parsed_artifact_info['change_id'])
                 artifact_info['change_project'] = listing.change_project
                 artifact_info['change_subject'] = listing.change_subject
@@ -174,7 +174,8 @@ def get_matching_artifact_urls(user_input):
                 if job:
                     artifact_info['status'] = job.status
                     artifact_job['status'] = job.status
-            except requests.HTTPError:
+            except requests.RequestException:
+                # details are optional, so don't fail if gerrit is down
                 pass
 
         return [artifact_info]
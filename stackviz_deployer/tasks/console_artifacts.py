@@ -12,62 +12,228 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import calendar
+import datetime
 import gzip
 import json
+import re
+import tempfile
 import uuid
 
-import requests
-
-from bs4 import BeautifulSoup
 from StringIO import StringIO
 
+from stackviz_deployer import metrics
+from stackviz_deployer.db import blob_store
 from stackviz_deployer.db.models import ArtifactBlob
 from stackviz_deployer.parser import console_parser
+from stackviz_deployer.tasks import fetch
+from stackviz_deployer.tasks.scheduler import Scanner
 
 # the maximum allowed size for a console artifact that we will download
 CONSOLE_MAX_SIZE = 1024 * 1024 * 20  # 20 MiB
 
+# compressed output larger than this is spooled to disk rather than memory
+SPOOL_MAX_SIZE = 1024 * 1024 * 4  # 4 MiB
+
+# the version of the columnar 'console-index' format
+CONSOLE_INDEX_VERSION = 1
+
+# Regex to match console timestamps, e.g. '2016-03-01 17:20:34.123'
+REGEX_CONSOLE_DATE = re.compile(
+    r'^\s*(\d{4}-\d{2}-\d{2}) (\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?\s*$')
+
 
 class ConsoleScrapeError(Exception):
     pass
 
 
 def collect_console(artifact):
-    r = requests.get(artifact.abs_url())
-    if 'content-length' in r.headers:
-        if int(r.headers.get('content-length')) > CONSOLE_MAX_SIZE:
-            raise ConsoleScrapeError('Console artifact too large.')
-
-    soup = BeautifulSoup(r.text, 'lxml')
-    element = soup.select('pre')
-    if not element:
+    # parse lines as they are downloaded, stopping early once done
+    timer = metrics.StageTimer()
+    chunks = fetch.iter_artifact(artifact, CONSOLE_MAX_SIZE, timer=timer)
+    try:
+        # download and decompress time is charged to its own nested stages
+        with timer.stage('parse'):
+            reader = console_parser.ConsoleTextReader(chunks)
+            data = console_parser.parse_console_lines(reader)
+    finally:
+        chunks.close()
+
+    if not reader.found:
         raise ConsoleScrapeError('Could not find console output in artifact')
 
-    data = console_parser.parse_console(element[0].text)
-
     compressed = StringIO()
-    with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
-        json.dump(data, f)
+    with timer.stage('compress'):
+        with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+            json.dump(data, f)
+
+    timer.observe()
 
     compressed.seek(0)
+    data_hash, data_size = blob_store.put(compressed)
 
-    return ArtifactBlob(id=uuid.uuid4(),
+    blob = ArtifactBlob(id=uuid.uuid4(),
                         artifact_name=artifact.name,
                         artifact_type='console',
                         content_type='application/json',
                         content_encoding='gzip',
                         primary=True,
-                        data=compressed.read())
+                        data_hash=data_hash,
+                        data_size=data_size)
+
+    return [blob] + collect_console_sections(artifact, data)
 
 
-def scan_console(listing):
-    artifact = listing.get_file('console.html', 'console.html.gz')
-    if artifact:
-        return [collect_console(artifact)]
+class ConsoleDateParser(object):
+    """Converts console timestamps into integer milliseconds since epoch.
 
-    return None
+    Consoles have many lines per day, so the (comparatively slow) date part
+    is converted once per distinct day and cached.
+    """
+
+    def __init__(self):
+        self.days = {}
+
+    def parse(self, date_str):
+        m = REGEX_CONSOLE_DATE.match(date_str)
+        if not m:
+            return None
+
+        day, hours, minutes, seconds, fraction = m.groups()
+
+        if day not in self.days:
+            try:
+                d = datetime.datetime.strptime(day, '%Y-%m-%d')
+            except ValueError:
+                return None
+
+            self.days[day] = calendar.timegm(d.utctimetuple()) * 1000
+
+        ms = int(fraction.ljust(3, '0')[:3]) if fraction else 0
+
+        return (self.days[day] +
+                int(hours) * 3600000 +
+                int(minutes) * 60000 +
+                int(seconds) * 1000 +
+                ms)
+
+
+def encode_section(script, dates):
+    """Encode one parsed script section in a compact columnar format.
+
+    Timestamps are delta-encoded: `base` is the first timestamp in
+    milliseconds since epoch and `deltas[i]` is the number of milliseconds
+    since the previous timestamp (0 for the first). Lines whose timestamp
+    can't be parsed have a null delta.
+
+    :param script: a script section dict as returned by parse_console
+    :param dates: a ConsoleDateParser
+    :return: a tuple of (section dict, first timestamp, last timestamp)
+    """
+    base = None
+    prev = None
+    deltas = []
+    lines = []
+
+    for entry in script['lines']:
+        t = dates.parse(entry['date'])
+        if t is None:
+            deltas.append(None)
+        elif prev is None:
+            base = t
+            deltas.append(0)
+        else:
+            deltas.append(t - prev)
+
+        if t is not None:
+            prev = t
+
+        lines.append(entry['line'])
+
+    section = {
+        'name': script['name'],
+        'base': base,
+        'deltas': deltas,
+        'lines': lines
+    }
+
+    return section, base, prev
+
+
+def collect_console_sections(artifact, data):
+    """Create columnar 'console-sections' and 'console-index' blobs.
+
+    Each script section is encoded with :func:`encode_section` and gzipped
+    as an independent gzip member; the members are concatenated into the
+    'console-sections' blob. The small 'console-index' blob lists each
+    section's byte offset and length within it, so a viewer can range-fetch
+    and inflate only the sections it displays.
+
+    :param artifact: the console artifact
+    :param data: the parsed console, as returned by parse_console
+    :return: a list of blobs: 'console-sections' and 'console-index'
+    """
+    dates = ConsoleDateParser()
+    sections_id = uuid.uuid4()
+    index = []
+
+    out = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+    for script in data['scripts']:
+        section, start, end = encode_section(script, dates)
 
+        offset = out.tell()
+        with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+            json.dump(section, f, separators=(',', ':'))
+
+        index.append({
+            'name': section['name'],
+            'offset': offset,
+            'length': out.tell() - offset,
+            'count': len(section['lines']),
+            'start': start,
+            'end': end
+        })
+
+    out.seek(0)
+    sections_hash, sections_size = blob_store.put(out)
+    out.close()
 
-SCANNER_FUNCTIONS = [
-    scan_console
+    compressed = StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        json.dump({
+            'version': CONSOLE_INDEX_VERSION,
+            'status': data['status'],
+            'remaining': data['remaining'],
+            'sections_blob': str(sections_id),
+            'sections': index
+        }, f)
+
+    compressed.seek(0)
+    index_hash, index_size = blob_store.put(compressed)
+
+    return [ArtifactBlob(id=sections_id,
+                         artifact_name=artifact.name,
+                         artifact_type='console-sections',
+                         content_type='application/octet-stream',
+                         content_encoding=None,
+                         primary=False,
+                         data_hash=sections_hash,
+                         data_size=sections_size),
+            ArtifactBlob(id=uuid.uuid4(),
+                         artifact_name=artifact.name,
+                         artifact_type='console-index',
+                         content_type='application/json',
+                         content_encoding='gzip',
+                         primary=False,
+                         data_hash=index_hash,
+                         data_size=index_size)]
+
+
+SCANNERS = [
+    # only the job's own console log, at the top of the listing
+    Scanner(patterns=['console.html', 'console.html.gz'],
+            collector=collect_console,
+            max_depth=0,
+            first_only=True,
+            max_size=CONSOLE_MAX_SIZE)
 ]
@@ -0,0 +1,373 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import errno
+import io
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+from stackviz_deployer import metrics
+from stackviz_deployer.scraper import http_pool
+
+
+logger = logging.getLogger(__name__)
+
+# the number of bytes read from the network at a time
+CHUNK_SIZE = 64 * 1024
+
+# directory where downloaded artifacts are handed off to parse workers; must
+# be shared by fetch and parse workers
+SPOOL_DIR = os.environ.get(
+    'SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'stackviz-spool'))
+
+# the maximum number of bytes spooled for an artifact if no limit is given;
+# scanners declare their own limits (see `Scanner.max_size`)
+DEFAULT_MAX_SIZE = 1024 * 1024 * 32  # 32 MiB
+
+# spool files older than this many seconds are assumed to be abandoned (e.g.
+# by a lost parse task) and deleted; must exceed the longest expected wait
+# in the parse queue
+SPOOL_MAX_AGE = int(os.environ.get('SPOOL_MAX_AGE', str(60 * 60 * 6)))
+
+# the minimum number of seconds between sweeps of abandoned spool files
+SPOOL_SWEEP_INTERVAL = 60 * 10
+
+# response headers kept with spooled artifacts
+SPOOL_HEADERS = ['content-length', 'content-encoding', 'content-type']
+
+# content types of artifacts that are gzipped files, rather than gzip-encoded
+# responses
+GZIP_CONTENT_TYPES = ['application/x-gzip', 'application/gzip']
+
+
+class ArtifactTooLargeError(Exception):
+    """An error raised when an artifact exceeds its maximum download size."""
+    pass
+
+
+class SpooledResponse(object):
+    """A stand-in for a streamed response, replaying a spooled artifact.
+
+    Only the parts of `requests.Response` used by collectors are provided.
+    """
+
+    def __init__(self, spool):
+        self.headers = spool['headers']
+        self.raw = _SpoolFile(spool['path'])
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        while True:
+            chunk = self.raw.read(chunk_size)
+            if not chunk:
+                break
+
+            yield chunk
+
+    def close(self):
+        self.raw.close()
+
+
+class _SpoolFile(object):
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+
+    def read(self, size=-1, decode_content=False):
+        # content is spooled exactly as received, so never decoded here
+        return self.f.read(size)
+
+    def close(self):
+        self.f.close()
+
+
+@contextlib.contextmanager
+def open_response(artifact):
+    """Open an artifact's raw response, from its spool file if it has one.
+
+    :param artifact: the artifact to open
+    :return: a context manager yielding a streamed `requests.Response` or a
+             :class:`SpooledResponse`
+    """
+    if artifact.spool is not None:
+        r = SpooledResponse(artifact.spool)
+        try:
+            yield r
+        finally:
+            r.close()
+    else:
+        with http_pool.stream(artifact.abs_url()) as r:
+            yield r
+
+
+def spool_artifact(artifact, max_size=DEFAULT_MAX_SIZE,
+                   chunk_size=CHUNK_SIZE):
+    """Download an artifact as-is into a file in `SPOOL_DIR`.
+
+    Nothing is decompressed or parsed, so this is almost entirely network
+    bound. Artifacts whose `content-length` exceeds `max_size` are rejected
+    before their body is read. The returned spool can be assigned to
+    `artifact.spool` (e.g. in another process) to collect the artifact
+    without downloading it again, and should be removed with
+    :func:`remove_spool` afterward.
+
+    :param artifact: the artifact to download
+    :param max_size: the maximum number of bytes to accept
+    :param chunk_size: the number of bytes to read at a time
+    :raises ArtifactTooLargeError: if the artifact exceeds `max_size`
+    :return: a JSON-serializable dict with the spool file's 'path' and the
+             response's relevant 'headers'
+    """
+    try:
+        os.makedirs(SPOOL_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # every host spooling artifacts periodically cleans up its own spool
+    # directory
+    if time.time() - _last_sweep[0] > SPOOL_SWEEP_INTERVAL:
+        sweep_spool()
+
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with metrics.time_stage('download'):
+                with http_pool.stream(artifact.abs_url()) as r:
+                    r.raise_for_status()
+
+                    length = r.headers.get('content-length')
+                    if length is not None and int(length) > max_size:
+                        raise ArtifactTooLargeError(
+                            'Artifact too large: %s' % artifact.name)
+
+                    headers = {}
+                    for name in SPOOL_HEADERS:
+                        if name in r.headers:
+                            headers[name] = r.headers[name]
+
+                    received = 0
+                    while True:
+                        chunk = r.raw.read(chunk_size, decode_content=False)
+                        if not chunk:
+                            break
+
+                        received += len(chunk)
+                        if received > max_size:
+                            raise ArtifactTooLargeError(
+                                'Artifact too large: %s' % artifact.name)
+
+                        f.write(chunk)
+    except Exception:
+        os.unlink(path)
+        raise
+
+    metrics.ARTIFACT_BYTES.labels('download').observe(received)
+
+    return {'path': path, 'headers': headers}
+
+
+def remove_spool(spool):
+    try:
+        os.unlink(spool['path'])
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+# the time of this process's last sweep, in a list so it can be updated
+_last_sweep = [0]
+
+
+def sweep_spool(max_age=SPOOL_MAX_AGE):
+    """Delete spool files abandoned for longer than `max_age` seconds.
+
+    Spool files are normally removed once parsed, but may be left behind if
+    a parse task is lost, e.g. when a worker is killed.
+
+    :param max_age: the minimum age in seconds of files to delete
+    :return: the number of files deleted
+    """
+    _last_sweep[0] = time.time()
+    cutoff = time.time() - max_age
+
+    try:
+        names = os.listdir(SPOOL_DIR)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+        return 0
+
+    deleted = 0
+    for name in names:
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+                deleted += 1
+        except OSError as e:
+            # removed concurrently, e.g. by its parse task
+            if e.errno != errno.ENOENT:
+                raise
+
+    if deleted:
+        logger.info('Removed %d abandoned spool files', deleted)
+
+    return deleted
+
+
+def _gzip_decoder():
+    # 16 + MAX_WBITS: expect a gzip header and trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def iter_artifact(artifact, max_size, chunk_size=CHUNK_SIZE, timer=None):
+    """Download an artifact, yielding its decompressed content in chunks.
+
+    The size limit is enforced on the bytes actually received from the
+    server, so a missing or incorrect `content-length` header can't be used
+    to bypass it, and oversized artifacts are abandoned as soon as the limit
+    is crossed. Both gzip-encoded responses and gzipped files are decompressed
+    as they arrive. Artifacts that were already spooled (see
+    :func:`spool_artifact`) are read from their spool file instead, which is
+    timed as 'spool_read' rather than 'download' (the download itself was
+    already recorded when spooling).
+
+    :param artifact: the artifact to download
+    :type artifact: stackviz_deployer.scraper.artifacts_list.Artifact
+    :param max_size: the maximum number of (compressed) bytes to accept
+    :param chunk_size: the number of bytes to read at a time
+    :param timer: a :class:`metrics.StageTimer` charged with 'download' (or
+                  'spool_read') and 'decompress' time; if None, a new timer
+                  is used and observed when the download ends
+    :raises ArtifactTooLargeError: if the artifact exceeds `max_size`
+    :return: a generator of decompressed byte strings
+    """
+    own_timer = timer is None
+    if own_timer:
+        timer = metrics.StageTimer()
+
+    spooled = artifact.spool is not None
+    read_stage = 'spool_read' if spooled else 'download'
+
+    try:
+        with open_response(artifact) as r:
+            r.raise_for_status()
+
+            length = r.headers.get('content-length')
+            if length is not None and int(length) > max_size:
+                raise ArtifactTooLargeError(
+                    'Artifact too large: %s' % artifact.name)
+
+            decoders = []
+            if r.headers.get('content-encoding') == 'gzip':
+                decoders.append(_gzip_decoder())
+
+            if r.headers.get('content-type') in GZIP_CONTENT_TYPES:
+                decoders.append(_gzip_decoder())
+
+            received = 0
+            decompressed = 0
+            while True:
+                with timer.stage(read_stage):
+                    chunk = r.raw.read(chunk_size, decode_content=False)
+                if not chunk:
+                    break
+
+                received += len(chunk)
+                if received > max_size:
+                    raise ArtifactTooLargeError(
+                        'Artifact too large: %s' % artifact.name)
+
+                with timer.stage('decompress'):
+                    for decoder in decoders:
+                        chunk = decoder.decompress(chunk)
+
+                if chunk:
+                    decompressed += len(chunk)
+                    yield chunk
+
+            # flush each decoder in order, passing leftovers down the chain
+            with timer.stage('decompress'):
+                tail = ''
+                for decoder in decoders:
+                    tail = decoder.decompress(tail) + decoder.flush()
+
+            if tail:
+                decompressed += len(tail)
+                yield tail
+
+            if not spooled:
+                metrics.ARTIFACT_BYTES.labels('download').observe(received)
+            metrics.ARTIFACT_BYTES.labels('decompressed').observe(decompressed)
+    finally:
+        if own_timer:
+            timer.observe()
+
+
+class ChunkReader(io.RawIOBase):
+    """A read-only file-like object over a generator of byte strings."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = ''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+
+        return n
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.chunks.close()
+            except ValueError:
+                # still being read from another thread; it will be released
+                # when that thread finishes with it
+                pass
+
+        super(ChunkReader, self).close()
+
+
+def open_artifact(artifact, max_size, chunk_size=CHUNK_SIZE, timer=None):
+    """Open an artifact as a buffered, decompressed file-like stream.
+
+    See :func:`iter_artifact` for details on size limits and decompression.
+    The returned stream should be closed to release the connection.
+
+    :param artifact: the artifact to download
+    :param max_size: the maximum number of (compressed) bytes to accept
+    :param chunk_size: the number of bytes to read at a time
+    :param timer: an optional :class:`metrics.StageTimer`
+    :return: a readable file-like object
+    """
+    reader = ChunkReader(iter_artifact(artifact, max_size, chunk_size, timer))
+    return io.BufferedReader(reader, buffer_size=chunk_size)
@@ -0,0 +1,123 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import time
+
+import redis
+import simplejson
+
+from stackviz_deployer.db import redis_conn
+
+
+logger = logging.getLogger(__name__)
+
+# prefix of the per-task redis pub/sub channels
+PROGRESS_CHANNEL_PREFIX = 'scrape-progress'
+
+# task states after which no further events are published
+FINAL_STATES = ['finished', 'error']
+
+# the number of seconds per-task progress counters are kept
+COUNTER_TTL = 60 * 60 * 6
+
+
+def channel_name(task_id):
+    return '%s:%s' % (PROGRESS_CHANNEL_PREFIX, task_id)
+
+
+def publish(task_id, status, message=None, **kwargs):
+    """Publish a progress event for a task.
+
+    Events are best-effort: redis errors are logged and otherwise ignored,
+    since clients can always fall back to polling `/status`.
+
+    :param task_id: the task's UUID
+    :param status: the task status, e.g. 'pending' or 'finished'
+    :param message: an optional status message
+    :param kwargs: extra fields to include in the event
+    """
+    event = dict(kwargs)
+    event['uuid'] = str(task_id)
+    event['status'] = status
+    event['message'] = message
+
+    try:
+        redis_conn.get_client().publish(channel_name(task_id),
+                                        simplejson.dumps(event))
+    except redis.RedisError as e:
+        logger.warning('Failed to publish progress for %s: %s', task_id, e)
+
+
+def count_completed(task_id):
+    """Count one more finished artifact of a task, across all workers.
+
+    :param task_id: the task's UUID
+    :return: the number of artifacts finished so far, or None if unavailable
+    """
+    key = '%s:completed:%s' % (PROGRESS_CHANNEL_PREFIX, task_id)
+
+    try:
+        pipe = redis_conn.get_client().pipeline()
+        pipe.incr(key)
+        pipe.expire(key, COUNTER_TTL)
+        return pipe.execute()[0]
+    except redis.RedisError as e:
+        logger.warning('Failed to count progress for %s: %s', task_id, e)
+        return None
+
+
+class Subscription(object):
+    """A subscription to the progress events of a single task.
+
+    Subscribe before reading the task's current state from the database, so
+    that no transition can be missed between the two.
+    """
+
+    def __init__(self, task_id):
+        self.pubsub = redis_conn.get_client().pubsub(
+            ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel_name(task_id))
+
+    def iter_events(self, timeout, keepalive):
+        """Yield events until a final state is seen or `timeout` passes.
+
+        :param timeout: the maximum number of seconds to wait, in total
+        :param keepalive: yield None after this many seconds without events
+        :return: a generator of event dicts, or None on keepalive
+        """
+        deadline = time.time() + timeout
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+
+            message = self.pubsub.get_message(
+                timeout=min(keepalive, remaining))
+            if message is None:
+                yield None
+                continue
+
+            event = simplejson.loads(message['data'])
+            yield event
+
+            if event['status'] in FINAL_STATES:
+                return
+
+    def close(self):
+        try:
+            self.pubsub.close()
+        except redis.RedisError:
+            pass
@@ -0,0 +1,92 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+
+import redis
+
+from prometheus_client.core import GaugeMetricFamily
+
+from stackviz_deployer.db import redis_conn
+
+
+logger = logging.getLogger(__name__)
+
+# lanes for new scrapes: single scrapes requested from the UI are kept apart
+# from batch submissions so they never wait behind them
+INTERACTIVE_QUEUE = os.environ.get('INTERACTIVE_QUEUE', 'interactive')
+BULK_QUEUE = os.environ.get('BULK_QUEUE', 'bulk')
+
+# the default celery queue, used for finishing scrapes
+DEFAULT_QUEUE = 'celery'
+
+# queues for network-bound downloads and CPU-bound parsing, so each can be
+# served by workers with a suitable pool type and concurrency (see README);
+# artifacts of interactive scrapes have their own, so they never wait behind
+# those of bulk scrapes either
+FETCH_QUEUE = os.environ.get('FETCH_QUEUE', 'fetch')
+PARSE_QUEUE = os.environ.get('PARSE_QUEUE', 'parse')
+INTERACTIVE_FETCH_QUEUE = os.environ.get('INTERACTIVE_FETCH_QUEUE',
+                                         'interactive.fetch')
+INTERACTIVE_PARSE_QUEUE = os.environ.get('INTERACTIVE_PARSE_QUEUE',
+                                         'interactive.parse')
+
+ALL_QUEUES = [INTERACTIVE_QUEUE, BULK_QUEUE, DEFAULT_QUEUE,
+              FETCH_QUEUE, PARSE_QUEUE,
+              INTERACTIVE_FETCH_QUEUE, INTERACTIVE_PARSE_QUEUE]
+
+
+def fetch_queue(lane):
+    """Return the queue for artifact downloads of scrapes in a lane."""
+    if lane == INTERACTIVE_QUEUE:
+        return INTERACTIVE_FETCH_QUEUE
+
+    return FETCH_QUEUE
+
+
+def parse_queue(lane):
+    """Return the queue for artifact parsing of scrapes in a lane."""
+    if lane == INTERACTIVE_QUEUE:
+        return INTERACTIVE_PARSE_QUEUE
+
+    return PARSE_QUEUE
+
+
+def queue_length(name):
+    """Return the number of messages waiting in a broker queue.
+
+    :param name: the queue name
+    :raises redis.RedisError: if the broker can't be reached
+    """
+    # the redis transport keeps each queue as a list named after it
+    return redis_conn.get_client(redis_conn.REDIS_BROKER_DB).llen(name)
+
+
+class QueueLengthCollector(object):
+    """A Prometheus collector reporting broker queue lengths when scraped."""
+
+    def collect(self):
+        gauge = GaugeMetricFamily('stackviz_queue_length',
+                                  'Messages waiting in each Celery queue',
+                                  labels=['queue'])
+
+        for name in ALL_QUEUES:
+            try:
+                gauge.add_metric([name], queue_length(name))
+            except redis.RedisError as e:
+                logger.warning('Could not get length of queue %s: %s',
+                               name, e)
+
+        yield gauge
@@ -0,0 +1,87 @@
+# Copyright 2016 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import fnmatch
+
+from stackviz_deployer import metrics
+from stackviz_deployer.scraper import crawler
+
+
+#: A single unit of scanner work: `collector(artifact)` downloads and
+#: processes the artifact, returning a list of ArtifactBlobs
+ScanJob = collections.namedtuple('ScanJob', ['collector', 'artifact'])
+
+#: A declaration of the files a scanner collects: files with names matching
+#: any of `patterns` are passed to `collector`. Matches are only looked for
+#: in directories at most `max_depth` levels below the root (or to the
+#: crawler's limit if None). If `first_only` is set, at most one file is
+#: collected per directory, e.g. when `patterns` lists alternate names for
+#: the same artifact. Files larger than `max_size` bytes (as downloaded) are
+#: rejected before being spooled.
+Scanner = collections.namedtuple('Scanner', ['patterns', 'collector',
+                                             'max_depth', 'first_only',
+                                             'max_size'])
+
+
+def run_job(job):
+    """Collect the job's artifact.
+
+    :param job: the :class:`ScanJob` to run
+    :return: a list of ArtifactBlobs
+    """
+    with metrics.SCANNER_SECONDS.labels(job.collector.__name__).time():
+        return job.collector(job.artifact)
+
+
+def _match(scanner, directory):
+    matches = []
+    for f in directory.files:
+        if any(fnmatch.fnmatch(f.name, p) for p in scanner.patterns):
+            matches.append(f)
+
+            if scanner.first_only:
+                break
+
+    return matches
+
+
+def find_jobs(listing, scanners, max_depth=crawler.CRAWL_MAX_DEPTH):
+    """Crawl the listing to find artifacts worth collecting.
+
+    The directory tree is crawled once (see :func:`crawler.crawl`) and every
+    directory is matched against all scanners' patterns, so no directory is
+    listed more than once per task.
+
+    :param listing: the root directory listing of the task
+    :param scanners: a list of :class:`Scanner`
+    :param max_depth: the deepest level of subdirectories to crawl
+    :return: a list of :class:`ScanJob`
+    """
+    # don't crawl deeper than any scanner is interested in
+    depths = [s.max_depth for s in scanners]
+    if depths and None not in depths:
+        max_depth = min(max_depth, max(depths))
+
+    jobs = []
+    with metrics.time_stage('crawl'):
+        for directory, depth in crawler.crawl(listing, max_depth):
+            for scanner in scanners:
+                if scanner.max_depth is not None and depth > scanner.max_depth:
+                    continue
+
+                for artifact in _match(scanner, directory):
+                    jobs.append(ScanJob(scanner.collector, artifact))
+
+    return jobs
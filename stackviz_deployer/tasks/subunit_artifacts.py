@@ -15,18 +15,27 @@
 import datetime
 import gzip
 import json
+import tempfile
 import uuid
 
-import requests
-
 from StringIO import StringIO
 
+from stackviz_deployer import metrics
+from stackviz_deployer.db import blob_store
 from stackviz_deployer.db.models import ArtifactBlob
 from stackviz_deployer.parser import subunit_parser
+from stackviz_deployer.tasks import fetch
+from stackviz_deployer.tasks.scheduler import Scanner
 
 
 # the maximum allowed size for a subunit artifact that we will download
-SUBUNIT_MAX_SIZE = 1024 * 1024 * 32  # 20 MiB
+SUBUNIT_MAX_SIZE = 1024 * 1024 * 32  # 32 MiB
+
+# the maximum allowed size for a dstat artifact that we will download
+DSTAT_MAX_SIZE = 1024 * 1024 * 32  # 32 MiB
+
+# compressed output larger than this is spooled to disk rather than memory
+SPOOL_MAX_SIZE = 1024 * 1024 * 4  # 4 MiB
 
 
 class ScrapeError(Exception):
@@ -40,50 +49,62 @@ def json_date_handler(o):
     return None
 
 
-def collect_subunit(artifact):
-    r = requests.get(artifact.abs_url())
-    if int(r.headers.get('content-length')) > SUBUNIT_MAX_SIZE:
-        raise ScrapeError('Subunit artifact too large.')
+def dump_json_array(items, fp, **kwargs):
+    """Incrementally encodes an iterable as a JSON array into `fp`.
 
-    subunit_content = StringIO(r.content)
-    if r.headers.get('content-type') == 'application/x-gzip':
-        with gzip.GzipFile(fileobj=subunit_content, mode='rb') as f:
-            subunit_content = StringIO(f.read())
+    Only one item is held by the encoder at a time, so `items` may be a
+    generator of arbitrary length. Extra keyword arguments are passed to the
+    underlying `json.JSONEncoder`.
 
-    data = subunit_parser.convert_stream(subunit_content,
-                                         strip_details=True)
-    compressed = StringIO()
-    with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
-        json.dump(data, f, default=json_date_handler)
+    :param items: an iterable of JSON-serializable objects
+    :param fp: a writable file-like object
+    :return: the number of items written
+    """
+    encoder = json.JSONEncoder(**kwargs)
 
-    compressed.seek(0)
+    count = 0
+    fp.write('[')
+    for item in items:
+        if count > 0:
+            fp.write(', ')
 
-    return ArtifactBlob(id=uuid.uuid4(),
-                        artifact_name=artifact.name,
-                        artifact_type='subunit',
-                        content_type='application/json',
-                        content_encoding='gzip',
-                        primary=True,
-                        data=compressed.read()), data
+        for chunk in encoder.iterencode(item):
+            fp.write(chunk)
+
+        count += 1
+    fp.write(']')
+
+    return count
 
 
-def collect_subunit_stats(artifact, raw_data):
-    start = None
-    end = None
-    total_duration = 0
-    failures = []
-    skips = []
+class SubunitStats(object):
+    """Accumulates summary statistics for subunit tests as they are parsed.
+
+    Entries are fed one at a time via :meth:`add`, so stats can be computed
+    in the same pass that encodes the test results without needing the full
+    list of tests.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.start = None
+        self.end = None
+        self.total_duration = 0
+        self.failures = []
+        self.skips = []
+
+    def add(self, entry):
+        self.count += 1
 
-    for entry in raw_data:
         # find min/max dates
         entry_start, entry_end = entry['timestamps']
-        if start is None or entry_start < start:
-            start = entry_start
+        if self.start is None or entry_start < self.start:
+            self.start = entry_start
 
-        if end is None or entry_end > end:
-            end = entry_end
+        if self.end is None or entry_end > self.end:
+            self.end = entry_end
 
-        total_duration += entry['duration']
+        self.total_duration += entry['duration']
 
         # find details for unsuccessful tests (fail or skip)
         if entry['status'] == 'fail':
@@ -92,103 +113,243 @@ def collect_subunit_stats(artifact, raw_data):
             msg = None
             if 'traceback' in entry['details']:
                 msg = entry['details']['traceback'].strip().splitlines()[-2:]
-                if 'Details' not in msg[1]:
+                if len(msg) > 1 and 'Details' not in msg[1]:
                     msg.remove(msg[0])
 
-            failures.append({
+            self.failures.append({
                 'name': entry['name'],
                 'duration': entry['duration'],
                 'details': msg
             })
         elif entry['status'] == 'skip':
-            skips.append({
+            self.skips.append({
                 'name': entry['name'],
                 'duration': entry['duration'],
                 'details': entry['details'].get('reason')
             })
 
-    data = {
-        'count': len(raw_data),
-        'start': start,
-        'end': end,
-        'total_duration': total_duration,
-        'failures': failures,
-        'skips': skips
-    }
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'start': self.start,
+            'end': self.end,
+            'total_duration': self.total_duration,
+            'failures': self.failures,
+            'skips': self.skips
+        }
 
-    compressed = StringIO()
-    with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
-        json.dump(data, f, default=json_date_handler)
+
+class DetailsWriter(object):
+    """Writes per-test details (tracebacks, logs, etc) to a side channel.
+
+    Each test's details are gzipped as an independent gzip member and
+    appended to a single spooled file, recording the member's byte offset
+    and length by test name. Details of a single test can then be fetched
+    with an HTTP range request and inflated on their own, keeping them out
+    of the main results blob.
+    """
+
+    def __init__(self):
+        self.out = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+
+        # test name -> list of [offset, length], in case of repeated names
+        self.index = {}
+
+    def write(self, name, details):
+        offset = self.out.tell()
+        with gzip.GzipFile(fileobj=self.out, mode='wb', mtime=0) as f:
+            json.dump({'name': name, 'details': details}, f)
+
+        entry = [offset, self.out.tell() - offset]
+        self.index.setdefault(name, []).append(entry)
+
+    def close(self):
+        self.out.close()
+
+
+def collect_subunit(artifact):
+    """Download and convert a subunit artifact in a single pass.
+
+    Tests are encoded into the result blob as they are parsed while
+    simultaneously being fed to a :class:`SubunitStats` accumulator, so the
+    full list of results is never held in memory. Test details are moved to
+    a separate, indexed side channel (see :class:`DetailsWriter`).
+
+    :param artifact: the subunit artifact to collect
+    :return: a list of blobs: the 'subunit' results, 'subunit-stats',
+             'subunit-compact', and if any tests have details,
+             'subunit-details' and 'subunit-details-index'
+    """
+    timer = metrics.StageTimer()
+    subunit_content = fetch.open_artifact(artifact, SUBUNIT_MAX_SIZE,
+                                          timer=timer)
+    stats = SubunitStats()
+    compact = subunit_parser.CompactResults()
+    details = DetailsWriter()
+
+    def accumulate(records):
+        while True:
+            # time spent waiting on the parser isn't charged to 'compress'
+            with timer.pause():
+                record = next(records, None)
+
+            if record is None:
+                break
+
+            stats.add(record)
+            compact.add(record)
+
+            if record['details']:
+                details.write(record['name'], record['details'])
+                record['details'] = {}
+
+            yield record
+
+    try:
+        records = subunit_parser.iter_stream(subunit_content, timer=timer)
+        compressed = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+        with timer.stage('compress'):
+            with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+                dump_json_array(accumulate(records), f,
+                                default=json_date_handler)
+    finally:
+        subunit_content.close()
+
+    timer.observe()
+    metrics.SUBUNIT_TESTS.observe(stats.count)
 
     compressed.seek(0)
+    data_hash, data_size = blob_store.put(compressed)
+    compressed.close()
 
-    return ArtifactBlob(id=uuid.uuid4(),
+    blob = ArtifactBlob(id=uuid.uuid4(),
                         artifact_name=artifact.name,
-                        artifact_type='subunit-stats',
+                        artifact_type='subunit',
                         content_type='application/json',
                         content_encoding='gzip',
-                        primary=False,
-                        data=compressed.read())
+                        primary=True,
+                        data_hash=data_hash,
+                        data_size=data_size)
 
+    blobs = [blob,
+             collect_subunit_stats(artifact, stats),
+             collect_subunit_compact(artifact, compact)]
 
-def collect_dstat(artifact):
-    r = requests.get(artifact.abs_url(), stream=True)
-
-    # reuse pre-gzipped data if possible
-    if r.headers.get('content-encoding') == 'gzip':
-        compressed = r.raw
-    else:
-        compressed = StringIO()
-        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
-            for chunk in r.iter_content():
-                f.write(chunk)
-        compressed.seek(0)
+    try:
+        if details.index:
+            blobs.extend(collect_subunit_details(artifact, details))
+    finally:
+        details.close()
+
+    return blobs
+
+
+def collect_subunit_stats(artifact, stats):
+    compressed = StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        json.dump(stats.to_dict(), f, default=json_date_handler)
+
+    compressed.seek(0)
+    data_hash, data_size = blob_store.put(compressed)
 
     return ArtifactBlob(id=uuid.uuid4(),
                         artifact_name=artifact.name,
-                        artifact_type='dstat',
-                        content_type='text/csv',
+                        artifact_type='subunit-stats',
+                        content_type='application/json',
                         content_encoding='gzip',
                         primary=False,
-                        data=compressed.read())
+                        data_hash=data_hash,
+                        data_size=data_size)
 
 
-def scan_subunit(listing):
-    dirs = [listing]
-    if listing.has_directory('logs'):
-        # if a 'logs' dir exists, scan it too
-        dirs.append(listing.get_directory('logs').browse())
-
-    found = []
+def collect_subunit_compact(artifact, compact):
+    compressed = StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        json.dump(compact.to_dict(), f, separators=(',', ':'))
 
-    for d in dirs:
-        for artifact in d.get_files_glob('*.subunit', '*.subunit.gz'):
-            blob, raw = collect_subunit(artifact)
-            found.append(blob)
+    compressed.seek(0)
+    data_hash, data_size = blob_store.put(compressed)
 
-            blob = collect_subunit_stats(artifact, raw)
-            found.append(blob)
+    return ArtifactBlob(id=uuid.uuid4(),
+                        artifact_name=artifact.name,
+                        artifact_type='subunit-compact',
+                        content_type='application/json',
+                        content_encoding='gzip',
+                        primary=False,
+                        data_hash=data_hash,
+                        data_size=data_size)
 
-    return found
 
+def collect_subunit_details(artifact, details):
+    details_id = uuid.uuid4()
 
-def scan_dstat(listing):
-    dirs = [listing]
-    if listing.has_directory('logs'):
-        # if a 'logs' dir exists, scan it too
-        dirs.append(listing.get_directory('logs').browse())
+    details.out.seek(0)
+    details_hash, details_size = blob_store.put(details.out)
 
-    found = []
-    for d in dirs:
-        artifact = d.get_file('dstat-csv.txt', 'dstat-csv.txt.gz')
-        if artifact:
-            found.append(collect_dstat(artifact))
+    compressed = StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        json.dump({
+            'details_blob': str(details_id),
+            'tests': details.index
+        }, f)
 
-    # dstat is never a primary artifact, so always return [found], 0
-    return found
+    compressed.seek(0)
+    index_hash, index_size = blob_store.put(compressed)
+
+    return [ArtifactBlob(id=details_id,
+                         artifact_name=artifact.name,
+                         artifact_type='subunit-details',
+                         content_type='application/octet-stream',
+                         content_encoding=None,
+                         primary=False,
+                         data_hash=details_hash,
+                         data_size=details_size),
+            ArtifactBlob(id=uuid.uuid4(),
+                         artifact_name=artifact.name,
+                         artifact_type='subunit-details-index',
+                         content_type='application/json',
+                         content_encoding='gzip',
+                         primary=False,
+                         data_hash=index_hash,
+                         data_size=index_size)]
 
 
-SCANNER_FUNCTIONS = [
-    scan_subunit,
-    scan_dstat
+def collect_dstat(artifact):
+    with fetch.open_response(artifact) as r:
+        # reuse pre-gzipped data if possible
+        if r.headers.get('content-encoding') == 'gzip':
+            data_hash, data_size = blob_store.put(r.raw)
+        else:
+            compressed = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+            with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+                for chunk in r.iter_content(fetch.CHUNK_SIZE):
+                    f.write(chunk)
+
+            compressed.seek(0)
+            data_hash, data_size = blob_store.put(compressed)
+            compressed.close()
+
+    return [ArtifactBlob(id=uuid.uuid4(),
+                         artifact_name=artifact.name,
+                         artifact_type='dstat',
+                         content_type='text/csv',
+                         content_encoding='gzip',
+                         primary=False,
+                         data_hash=data_hash,
+                         data_size=data_size)]
+
+
+SCANNERS = [
+    Scanner(patterns=['*.subunit', '*.subunit.gz'],
+            collector=collect_subunit,
+            max_depth=None,
+            first_only=False,
+            max_size=SUBUNIT_MAX_SIZE),
+
+    # dstat is never a primary artifact
+    Scanner(patterns=['dstat-csv.txt', 'dstat-csv.txt.gz'],
+            collector=collect_dstat,
+            max_depth=None,
+            first_only=True,
+            max_size=DSTAT_MAX_SIZE)
 ]
@@ -12,88 +12,334 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
 import logging
 import os
+import time
 import uuid
 
 from celery import Celery
+from celery import chain
+from celery import chord
+from celery.signals import worker_init
 
+from stackviz_deployer import metrics
+from stackviz_deployer.db import blob_store
 from stackviz_deployer.db import database
+from stackviz_deployer.db import redis_conn
+from stackviz_deployer.db.models import ArtifactBlob
 from stackviz_deployer.db.models import ScrapeTask
 from stackviz_deployer.scraper import artifacts_list
 from stackviz_deployer.tasks import console_artifacts
+from stackviz_deployer.tasks import fetch
+from stackviz_deployer.tasks import progress
+from stackviz_deployer.tasks import queues
+from stackviz_deployer.tasks import scheduler
 from stackviz_deployer.tasks import subunit_artifacts
 
 
 logger = logging.getLogger(__name__)
 
-# connection settings for redis (as needed by celery), using docker-style ENV
-# when available
-REDIS_HOST = os.environ.get('REDIS_PORT_6379_TCP_ADDR', 'localhost')
-REDIS_PORT = os.environ.get('REDIS_PORT_6379_TCP_PORT', '6379')
-
-app = Celery('tasks', broker='redis://{}:{}/0'.format(REDIS_HOST, REDIS_PORT))
+app = Celery('tasks',
+             broker=redis_conn.get_url(),
+             backend=redis_conn.get_url(redis_conn.REDIS_RESULT_DB))
 app.conf.CELERY_TASK_SERIALIZER = 'json'
 app.conf.CELERY_RESULT_SERIALIZER = 'json'
 
-# a list of all available scanner functions (to be extended later)
-SCANNER_FUNCTIONS = []
-SCANNER_FUNCTIONS.extend(subunit_artifacts.SCANNER_FUNCTIONS)
-SCANNER_FUNCTIONS.extend(console_artifacts.SCANNER_FUNCTIONS)
+# results are only needed until a scrape's chord completes
+app.conf.CELERY_TASK_RESULT_EXPIRES = 60 * 60 * 6
+
+# the interval in seconds between sweeps of unreferenced blobs, when run with
+# celery beat
+BLOB_SWEEP_INTERVAL = int(os.environ.get('BLOB_SWEEP_INTERVAL',
+                                         str(60 * 60 * 6)))
+
+# a list of all available scanners (to be extended later)
+SCANNERS = []
+SCANNERS.extend(subunit_artifacts.SCANNERS)
+SCANNERS.extend(console_artifacts.SCANNERS)
+
+# collectors by name, so subtasks can be sent a serializable reference
+COLLECTORS = dict((s.collector.__name__, s.collector) for s in SCANNERS)
+
+# the maximum download size of each collector's artifacts, by collector name
+MAX_SIZES = dict((s.collector.__name__, s.max_size) for s in SCANNERS)
 
 # TODO(Tim Buckley): should also have a list of validator functions (of which
 # >= 1 must return True)
 
 
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    if metrics.WORKER_METRICS_PORT:
+        metrics.start_server(metrics.WORKER_METRICS_PORT)
+
+
+@worker_init.connect
+def sweep_spool(**kwargs):
+    # clean up after workers that were stopped mid-scrape
+    fetch.sweep_spool()
+
+
+def _save_blobs(task_id, blobs):
+    """Insert a batch of blobs for a task in one short transaction.
+
+    Blob content is already in the blob store, so only metadata is written.
+    The session is removed afterward so no connection is held while the next
+    artifacts are downloaded.
+    """
+    if not blobs:
+        return
+
+    for blob in blobs:
+        blob.task_id = task_id
+
+    try:
+        with metrics.time_stage('db_commit'):
+            database.session.bulk_save_objects(blobs)
+            database.session.commit()
+    finally:
+        database.session.remove()
+
+
+def _finish_task(task_id, status, message=None):
+    """Record the final state of a task.
+
+    Failed tasks have any blobs saved so far removed, and release their URL
+    so it can be scraped again. Only the rows are removed: the content may be
+    shared with other tasks, so files left unreferenced are deleted later by
+    :func:`sweep_blobs`.
+    """
+    try:
+        db_task = database.session.query(ScrapeTask) \
+            .filter_by(id=task_id).first()
+
+        db_task.status = status
+        db_task.message = message
+
+        if status == 'error':
+            database.session.query(ArtifactBlob) \
+                .filter_by(task_id=task_id) \
+                .delete(synchronize_session=False)
+
+            db_task.url_key = None
+
+        with metrics.time_stage('db_commit'):
+            database.session.commit()
+    finally:
+        database.session.remove()
+
+    progress.publish(task_id, status, message)
+
+
+def submit_scrape(task_id, lane=queues.INTERACTIVE_QUEUE):
+    """Queue a scrape task in the given lane.
+
+    :param task_id: the task's UUID
+    :param lane: the queue to submit to, `queues.INTERACTIVE_QUEUE` or
+                 `queues.BULK_QUEUE`
+    """
+    request_scrape.apply_async(args=[str(task_id), time.time(), lane],
+                               queue=lane)
+
+
 @app.task
-def request_scrape(task_id):
+def request_scrape(task_id, queued_at=None, lane=None):
+    """Find a task's artifacts and fan out subtasks to collect each.
+
+    Each artifact is downloaded by a :func:`fetch_artifact` subtask on the
+    lane's fetch queue, then parsed by a :func:`process_artifact` subtask on
+    the lane's parse queue. Once all have finished, :func:`finish_scrape`
+    records the task's final status.
+    """
+    if queued_at is not None:
+        metrics.QUEUE_WAIT_SECONDS.labels(lane).observe(
+            max(0, time.time() - queued_at))
+
     task_id = uuid.UUID(task_id)
     db_task = database.session.query(ScrapeTask).filter_by(id=task_id).first()
     if not db_task:
         # shouldn't happen...
+        database.session.remove()
         return
 
     # TODO(Tim Buckley) validate input (check url, etc...)
+    url = db_task.url
 
-    # mark the task as pending so clients can see some degree of feedback
+    # mark the task as pending so clients can see some degree of feedback,
+    # then release the connection for the (potentially slow) scrape
     db_task.status = 'pending'
     database.session.add(db_task)
     database.session.commit()
+    database.session.remove()
+    progress.publish(task_id, 'pending')
 
-    logger.info('Starting task %s, url=%s' % (str(task_id), db_task.url))
+    logger.info('Starting task %s, url=%s' % (str(task_id), url))
+    start = time.time()
 
     try:
-        artifacts = artifacts_list.DirectoryListing(db_task.url)
-
-        # all blobs found by the crawler
-        found_blobs = []
-
-        # run all scanner functions to scrape this directory listing
-        for func in SCANNER_FUNCTIONS:
-            found_blobs.extend(func(artifacts))
-
-        # of found_blobs, the # that are actually useful as standalone data
-        # (e.g., if we only find dstat, we should error regardless since that
-        # is uninteresting by itself)
-        primary_blob_count = sum(map(lambda b: 1 if b.primary else 0,
-                                     found_blobs))
-
-        # make sure we found at least 1 primary artifact, otherwise fail the
-        # job (i.e. 'nothing to see here' error)
-        if primary_blob_count > 0:
-            for blob in found_blobs:
-                blob.task_id = db_task.id
-                database.session.add(blob)
-        else:
-            db_task.status = 'error'
-            db_task.message = 'no supported artifacts could be found'
+        artifacts = artifacts_list.DirectoryListing(url)
+
+        # crawl this directory listing for files matching any scanner
+        jobs = scheduler.find_jobs(artifacts, SCANNERS)
     except Exception as e:
         logger.exception('Exception in task ' + str(task_id) + ': ' + str(e))
-        db_task.status = 'error'
-        db_task.message = str(e)
+        _finish_task(task_id, 'error', str(e))
+        metrics.TASK_SECONDS.labels('error').observe(time.time() - start)
+        return
 
-    if db_task.status != 'error':
-        db_task.status = 'finished'
+    if not jobs:
+        _finish_task(task_id, 'error', 'no supported artifacts could be found')
+        metrics.TASK_SECONDS.labels('error').observe(time.time() - start)
+        return
 
-    database.session.add(db_task)
-    database.session.commit()
+    progress.publish(task_id, 'pending', completed=0, total=len(jobs))
+
+    subtasks = []
+    for job in jobs:
+        a = job.artifact
+        subtasks.append(chain(
+            fetch_artifact.s(str(task_id), job.collector.__name__,
+                             [a.base_url, a.rel_url, a.entry_type, a.name],
+                             len(jobs)).set(queue=queues.fetch_queue(lane)),
+            process_artifact.s().set(queue=queues.parse_queue(lane))))
+
+    chord(subtasks)(finish_scrape.s(str(task_id), start))
+
+
+@app.task
+def fetch_artifact(task_id, collector_name, artifact, total):
+    """Download a single artifact of a task into a spool file.
+
+    Runs on the fetch queue of the scrape's lane. Artifacts larger than the
+    collector's limit (see `MAX_SIZES`) are rejected without being
+    downloaded. Only the spool's path is passed on to
+    :func:`process_artifact`, never the artifact's content.
+
+    :param task_id: the task's UUID string
+    :param collector_name: the name of a collector in `COLLECTORS`
+    :param artifact: the artifact's [base_url, rel_url, entry_type, name]
+    :param total: the total number of artifacts in the task, for progress
+    :return: the arguments for :func:`process_artifact`, or a result dict
+             with an 'error' message if the download failed
+    """
+    try:
+        spool = fetch.spool_artifact(artifacts_list.Artifact(*artifact),
+                                     MAX_SIZES[collector_name])
+    except Exception as e:
+        logger.exception('Exception fetching %s in task %s: %s' % (
+            artifact[3], task_id, str(e)))
+        return {'primary': 0, 'error': str(e)}
+
+    return {
+        'task_id': task_id,
+        'collector': collector_name,
+        'artifact': artifact,
+        'total': total,
+        'spool': spool
+    }
+
+
+@app.task
+def process_artifact(fetched):
+    """Parse a spooled artifact of a task, saving its blobs immediately.
+
+    Runs on the parse queue of the scrape's lane. The spool file is always
+    removed afterward. Errors are returned rather than raised, so that the
+    chord always reaches :func:`finish_scrape`.
+
+    :param fetched: the return value of :func:`fetch_artifact`
+    :return: a dict with the number of 'primary' blobs found, and an 'error'
+             message if collection failed
+    """
+    if 'error' in fetched:
+        return fetched
+
+    task_id = uuid.UUID(fetched['task_id'])
+    artifact = artifacts_list.Artifact(*fetched['artifact'])
+
+    try:
+        artifact.spool = fetched['spool']
+        job = scheduler.ScanJob(COLLECTORS[fetched['collector']], artifact)
+
+        blobs = scheduler.run_job(job)
+        _save_blobs(task_id, blobs)
+    except Exception as e:
+        logger.exception('Exception collecting %s in task %s: %s' % (
+            artifact.name, str(task_id), str(e)))
+        database.session.rollback()
+        return {'primary': 0, 'error': str(e)}
+    finally:
+        fetch.remove_spool(fetched['spool'])
+
+    progress.publish(task_id, 'pending',
+                     completed=progress.count_completed(task_id),
+                     total=fetched['total'],
+                     artifact=artifact.name)
+
+    return {'primary': sum(1 for b in blobs if b.primary)}
+
+
+@app.task
+def finish_scrape(results, task_id, start):
+    """Record a task's final status once all its artifacts are collected.
+
+    :param results: the return values of each :func:`process_artifact`
+    :param task_id: the task's UUID string
+    :param start: the time the task was started
+    """
+    task_id = uuid.UUID(task_id)
+
+    errors = [r['error'] for r in results if 'error' in r]
+
+    # of the blobs found, the # that are actually useful as standalone data
+    # (e.g., if we only find dstat, we should error regardless since that is
+    # uninteresting by itself)
+    primary_blob_count = sum(r['primary'] for r in results)
+
+    # any failed artifact fails the whole task, and we need at least 1 primary
+    # artifact (i.e. 'nothing to see here' error)
+    if errors:
+        status, message = 'error', errors[0]
+    elif primary_blob_count > 0:
+        status, message = 'finished', None
+    else:
+        status = 'error'
+        message = 'no supported artifacts could be found'
+
+    _finish_task(task_id, status, message)
+    metrics.TASK_SECONDS.labels(status).observe(time.time() - start)
+
+
+def _referenced_hashes(digests):
+    rows = database.session.query(ArtifactBlob.data_hash) \
+        .filter(ArtifactBlob.data_hash.in_(digests)) \
+        .distinct()
+
+    return set(row.data_hash for row in rows)
+
+
+@app.task
+def sweep_blobs():
+    """Delete stored blobs no longer referenced by any task."""
+    try:
+        deleted = blob_store.sweep(_referenced_hashes)
+    finally:
+        database.session.remove()
+
+    logger.info('Swept %d unreferenced blobs', deleted)
+    return deleted
+
+
+app.conf.CELERYBEAT_SCHEDULE = {
+    'sweep-blobs': {
+        'task': sweep_blobs.name,
+        'schedule': datetime.timedelta(seconds=BLOB_SWEEP_INTERVAL)
+    }
+}
+
+app.conf.CELERY_ROUTES = {
+    fetch_artifact.name: {'queue': queues.FETCH_QUEUE},
+    process_artifact.name: {'queue': queues.PARSE_QUEUE},
+    finish_scrape.name: {'queue': queues.DEFAULT_QUEUE}
+}